@@ -130,7 +130,7 @@ class Client:
             # TODO: we return as soon as any download errors. Revisit this.
             await asyncio.gather(*self._tasks)
         except Exception as exc:
-            logger.error("%s received in client:start_all" % type(exc).__name__)
+            logger.error("%s received in client:start_all", type(exc).__name__)
 
         self.running = False
 
@@ -49,7 +49,7 @@ def Decode(data: bytes) -> Optional[BencodingTypes]:
         decoder = _Decoder(data)
         return decoder.decode()
     except DecodeError as exc:
-        logger.error("%s" % exc)
+        logger.error("%s", exc)
 
 
 def Encode(data: BencodingTypes) -> bytes:
@@ -63,7 +63,7 @@ def Encode(data: BencodingTypes) -> bytes:
         encoder = _Encoder(data)
         return encoder.encode()
     except EncodeError as exc:
-        logger.error("%s" % exc)
+        logger.error("%s", exc)
 
 
 class _Decoder:
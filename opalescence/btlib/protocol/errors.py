@@ -53,6 +53,13 @@ class PeerError(Exception):
     """
 
 
+class PeerMessageError(PeerError):
+    """
+    Raised when a message received from the peer can't be decoded.
+    The message was read in full, so the connection is still usable.
+    """
+
+
 class FileWriterError(Exception):
     """
     Raised when we encounter an error writing files.
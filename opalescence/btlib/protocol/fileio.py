@@ -8,15 +8,21 @@ from __future__ import annotations
 
 __all__ = ['FileItem', 'FileWriter']
 
+import bisect
 import dataclasses
 import logging
+import os
 from pathlib import Path
-from typing import Optional, BinaryIO
+from typing import Optional
 
 from .errors import FileWriterError
 
 logger = logging.getLogger(__name__)
 
+_HAS_PWRITE = hasattr(os, "pwrite")
+# Windows opens files in text mode unless told otherwise.
+_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+
 
 @dataclasses.dataclass
 class FileItem:
@@ -29,22 +35,34 @@ class FileItem:
     exists: bool
 
     @staticmethod
-    def file_for_offset(files: dict[int, FileItem], offset: int) -> tuple[int, int]:
+    def file_for_offset(files: dict[int, FileItem], offset: int,
+                        file_offsets: Optional[list[int]] = None
+                        ) -> Optional[tuple[int, int]]:
         """
         Given a contiguous offset (as if all files were concatenated together),
         returns the corresponding file index and offset within the file.
+        The file is found with a binary search over the files' offsets.
 
         :param files: dictionary of `FileItem`s keyed by their index order
         :param offset: the contiguous offset to find the file for
                        (as if all files were concatenated together)
-        :return: (file_index, offset_within_file)
+        :param file_offsets: the files' offsets in index order, so callers
+                             looking up many offsets only build them once
+        :return: (file_index, offset_within_file), or None if the offset is
+                 past the end of the last file
         """
-        size_sum = 0
-        for i, file in files.items():
-            if offset - size_sum < file.size:
-                file_offset = offset - size_sum
-                return i, file_offset
-            size_sum += file.size
+        if file_offsets is None:
+            file_offsets = [file.offset for file in files.values()]
+
+        # The last file starting at or before the offset. Empty files share
+        # their offset with the next file, which this skips past.
+        file_index = bisect.bisect_right(file_offsets, offset) - 1
+        if file_index < 0:
+            return
+        file_offset = offset - file_offsets[file_index]
+        if file_offset >= files[file_index].size:
+            return
+        return file_index, file_offset
 
 
 class FileWriter:
@@ -52,40 +70,39 @@ class FileWriter:
     def __init__(self, files: dict[int, FileItem], piece_length: int):
         self._files: dict[int, FileItem] = files
         self._piece_length = piece_length
-        self._fps: Optional[dict[int, BinaryIO]] = None
+        self._file_offsets: list[int] = [file.offset for file in files.values()]
+        self._fds: Optional[dict[int, int]] = None
 
     def open_files(self):
         """
         Opens/creates all the files that will be written and
-        stores the open streams for later use.
+        stores their file descriptors for later use.
         """
-        if self._files is None or len(self._files) == 0 or self._fps is not None:
+        if self._files is None or len(self._files) == 0 or self._fds is not None:
             return
 
         file = ""
-        self._fps = {}
+        self._fds = {}
         try:
             for i, file in self._files.items():
                 if not file.exists:
                     file.path.parent.mkdir(parents=True, exist_ok=True)
-                    self._fps[i] = open(file.path, 'wb+')
-                else:
-                    self._fps[i] = open(file.path, 'ab')
+                self._fds[i] = os.open(file.path, _OPEN_FLAGS, 0o666)
         except Exception as exc:
-            logger.error("Encountered %s exception opening %s" % (type(exc).__name__,
-                                                                  file.path))
+            logger.error("Encountered %s exception opening %s",
+                         type(exc).__name__, file.path)
             raise FileWriterError from exc
 
     def close_files(self):
         """
-        Closes all open file streams.
+        Closes all open files. Files can't be written once they're closed.
         """
-        if self._fps is None:
+        if self._fds is None:
             return
 
-        for fp in self._fps.values():
-            if not fp.closed:
-                fp.close()
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
 
     def _write_piece_data(self, piece):
         """
@@ -97,15 +114,17 @@ class FileWriter:
         assert piece.complete
 
         offset = piece.index * self._piece_length
-        data_to_write = piece.data
+        # Slices of a memoryview don't copy the piece's data.
+        data_to_write = memoryview(piece.data)
         while data_to_write:
-            file_num, file_offset = FileItem.file_for_offset(self._files, offset)
-            file = self._files[file_num]
-            if file_num not in self._files:
+            located = FileItem.file_for_offset(self._files, offset, self._file_offsets)
+            if located is None:
                 logger.error("Too much data and not enough file...")
                 raise FileWriterError
+            file_num, file_offset = located
+            file = self._files[file_num]
 
-            logger.info(f"Writing data to %s" % file.path)
+            logger.info("Writing data to %s", file.path)
 
             if file_offset + len(data_to_write) > file.size:
                 data_for_file = data_to_write[:file.size - file_offset]
@@ -119,21 +138,34 @@ class FileWriter:
     def _write_data(self, data_to_write, file_num, offset):
         """
         Writes data to the file in an executor so the main thread isn't blocked.
+        Writes go to the given offset directly with pwrite, so there's
+        no seek, and files that already exist are written in place.
+        `os.pwrite` is POSIX-only; elsewhere this falls back to seek + write,
+        which is safe because pieces are written one at a time.
 
-        :param data_to_write: data to write to file
-        :param file_num: file index in self._fps to write to
+        :param data_to_write: memoryview of the data to write to file
+        :param file_num: file index in self._fds to write to
         :param offset: Offset into the file to begin writing this data
 
         :raises: Any Exception received on writing.
         """
-        assert self._fps is not None
+        assert self._fds is not None
 
-        fp = self._fps[file_num]
+        path = self._files[file_num].path
         try:
-            if fp.closed:
-                raise FileWriterError("file already closed: %s" % fp.name)
-            fp.seek(offset, 0)
-            fp.write(data_to_write)
+            fd = self._fds.get(file_num)
+            if fd is None:
+                raise FileWriterError("file already closed: %s" % path)
+            data = data_to_write
+            if not _HAS_PWRITE:
+                os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                if _HAS_PWRITE:
+                    written = os.pwrite(fd, data, offset)
+                else:
+                    written = os.write(fd, data)
+                data = data[written:]
+                offset += written
         except Exception as exc:
-            logger.error("Encountered exception when writing to %s" % fp.name)
+            logger.error("Encountered exception when writing to %s", path)
             raise FileWriterError from exc
@@ -8,7 +8,8 @@ from __future__ import annotations
 
 __all__ = ['Message', 'Handshake', 'KeepAlive', 'Choke', 'Unchoke',
            'Interested', 'NotInterested', 'Have', 'Bitfield', 'Request',
-           'Block', 'Piece', 'Cancel', 'MESSAGE_TYPES', 'ProtocolMessage']
+           'Block', 'Piece', 'Cancel', 'MESSAGE_TYPES', 'DECODERS',
+           'ProtocolMessage']
 
 import hashlib
 import struct
@@ -27,6 +28,7 @@ class Message:
     Messages (except the initial handshake) look like:
     <Length prefix><Message ID><Payload>
     """
+    __slots__ = ()
 
     def __str__(self):
         return str(type(self).__name__)
@@ -55,14 +57,20 @@ class NoInfoMessage:
     message identifier and no additional info
     """
     msg_id = None
+    _encoded = b''
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # These messages never change, so they're only encoded once.
+        cls._encoded = struct.pack(">IB", 1, cls.msg_id)
 
     @classmethod
-    def decode(cls):
+    def decode(cls, data: bytes = b''):
         return cls()
 
     @classmethod
     def encode(cls) -> bytes:
-        return struct.pack(">IB", 1, cls.msg_id)
+        return cls._encoded
 
 
 class Handshake(Message):
@@ -110,16 +118,17 @@ class KeepAlive(Message):
 
     <0000>
     """
+    _encoded = struct.pack(">I", 0)
 
     @classmethod
     def encode(cls) -> bytes:
         """
         :return: encoded message to be sent to protocol
         """
-        return struct.pack(">I", 0)
+        return cls._encoded
 
     @classmethod
-    def decode(cls):
+    def decode(cls, data: bytes = b''):
         return cls()
 
 
@@ -166,6 +175,8 @@ class Have(Message):
     <0005><4><index>
     """
     msg_id = 4
+    fmt = struct.Struct(">I")
+    encoded_fmt = struct.Struct(">IBI")
 
     def __init__(self, index: int):
         self.index = index
@@ -185,15 +196,14 @@ class Have(Message):
         """
         :return: encoded message to be sent to protocol
         """
-        return struct.pack(">IBI", 5, self.msg_id, self.index)
+        return self.encoded_fmt.pack(5, self.msg_id, self.index)
 
     @classmethod
     def decode(cls, data: bytes) -> Have:
         """
         :return: an instance of the have message
         """
-        piece = struct.unpack(">I", data)[0]
-        return cls(piece)
+        return cls(*cls.fmt.unpack(data))
 
 
 class Bitfield(Message):
@@ -238,11 +248,11 @@ class Bitfield(Message):
         """
         :return: an instance of the bitfield message
         """
-        bitfield = struct.unpack(f">{len(data)}s", data)[0]
-        return cls(bitfield)
+        return cls(bytes(data))
 
 
 class IndexableMessage(Message):
+    __slots__ = ("index", "begin", "length")
     size = 2 ** 14
 
     def __init__(self, index: int, begin: int, length: int = size):
@@ -276,18 +286,28 @@ class Request(IndexableMessage):
 
     <0013><6><index><begin><length>
     """
+    # Requests are created for every block of the torrent and are hashed
+    # whenever they're tracked or looked up, so they're kept small and
+    # their hash is computed once.
+    __slots__ = ("peer_id", "requested_at", "num_retries", "_hash")
     msg_id = 6
     stale_time = 2
+    fmt = struct.Struct(">3I")
+    encoded_fmt = struct.Struct(">IB3I")
 
     def __init__(self, index, begin, length):
         super().__init__(index, begin, length)
         self.peer_id = None
         self.requested_at = None
         self.num_retries = 0
+        self._hash = hash((index, begin, length))
 
     def __str__(self):
         return f"Request: ({super().__str__()})"
 
+    def __hash__(self):
+        return self._hash
+
     def is_stale(self, current_time) -> bool:
         """
         :param current_time: Current time as a float value.
@@ -301,15 +321,14 @@ class Request(IndexableMessage):
         """
         :return: the request message encoded in bytes
         """
-        return struct.pack(">IB3I", 13, self.msg_id, self.index, self.begin, self.length)
+        return self.encoded_fmt.pack(13, self.msg_id, self.index, self.begin, self.length)
 
     @classmethod
     def decode(cls, data: bytes) -> Request:
         """
         :return: a decoded request message
         """
-        request = struct.unpack(">3I", data)
-        return cls(request[0], request[1], request[2])
+        return cls(*cls.fmt.unpack(data))
 
     @classmethod
     def from_block(cls, block: Block) -> Request:
@@ -329,6 +348,7 @@ class Block(IndexableMessage):
     <0009+X><7><index><begin><block>
     """
     msg_id = 7
+    fmt = struct.Struct(">II")
 
     def __init__(self, index: int, begin: int, length: int):
         self.data = b''
@@ -360,10 +380,9 @@ class Block(IndexableMessage):
         """
         :return: a decoded piece message
         """
-        data_len = len(data) - 8  # account for the index and begin bytes
-        piece_data = struct.unpack(f">II{data_len}s", data)
-        inst = cls(piece_data[0], piece_data[1], len(piece_data[2]))
-        inst.data = piece_data[2]
+        index, begin = cls.fmt.unpack_from(data)
+        inst = cls(index, begin, len(data) - 8)  # account for the index and begin bytes
+        inst.data = bytes(data[8:])
         return inst
 
 
@@ -374,6 +393,8 @@ class Cancel(IndexableMessage):
     <0013><8><index><begin><length>
     """
     msg_id = 8
+    fmt = struct.Struct(">3I")
+    encoded_fmt = struct.Struct(">IB3I")
 
     def __str__(self):
         return f"Cancel: ({super().__str__()})"
@@ -382,16 +403,15 @@ class Cancel(IndexableMessage):
         """
         :return: the cancel message encoded in bytes
         """
-        return struct.pack(">IBIII", 13, Cancel.msg_id, self.index, self.begin,
-                           self.length)
+        return self.encoded_fmt.pack(13, self.msg_id, self.index, self.begin,
+                                     self.length)
 
     @classmethod
     def decode(cls, data: bytes) -> Cancel:
         """
         :return: a decoded cancel message
         """
-        cancel_data = struct.unpack(">III", data)
-        return cls(cancel_data[0], cancel_data[1], cancel_data[2])
+        return cls(*cls.fmt.unpack(data))
 
 
 class Piece:
@@ -409,7 +429,15 @@ class Piece:
 
         self._block_size: int = block_size
         self._blocks: list[Block] = []
+        # Blocks are copied into the piece's buffer as they arrive;
+        # a byte per block records whether it has been received.
+        self._data: Optional[bytearray] = None
+        self._received: bytearray = bytearray()
         self._written: bool = False
+        # Blocks are hashed as soon as every block before them has arrived,
+        # so the hash is ready when the piece completes.
+        self._sha1 = hashlib.sha1()
+        self._num_hashed: int = 0
         self._create_blocks()
 
     def __str__(self):
@@ -419,7 +447,7 @@ class Piece:
         return str(self)
 
     def __hash__(self):
-        return hash((self.index, self.length, self.data))
+        return hash(self.index)
 
     def __eq__(self, other: Piece):
         if not isinstance(other, Piece):
@@ -430,9 +458,11 @@ class Piece:
         return equal
 
     @property
-    def data(self) -> bytes:
+    def data(self) -> Optional[bytearray]:
         if not self._written:
-            return b''.join([b.data for b in self._blocks])
+            if self._data is None:
+                return bytearray()
+            return self._data
 
     @property
     def complete(self) -> bool:
@@ -455,7 +485,8 @@ class Piece:
         """
         if self.complete:
             return []
-        return [block for block in self._blocks if len(block.data) == 0]
+        return [block for block, received in zip(self._blocks, self._received)
+                if not received]
 
     def _create_blocks(self):
         """
@@ -467,6 +498,9 @@ class Piece:
         num_blocks = (self.length + self._block_size - 1) // self._block_size
         self._blocks = [Block(self.index, idx * self._block_size, self._block_size)
                         for idx in range(num_blocks)]
+        self._received = bytearray(num_blocks)
+        # The buffer is only allocated once data arrives for the piece.
+        self._data = None
 
     def add_block(self, block: Block):
         """
@@ -479,12 +513,25 @@ class Piece:
         assert self.index == block.index
 
         block_index = block.begin // self._block_size
-        if block_index < -1 or block_index > len(self._blocks):
+        end = block.begin + len(block.data)
+        if block_index < 0 or block_index >= len(self._blocks) or end > self.length:
             raise NonSequentialBlockError
 
-        self._blocks[block_index] = block
+        if self._data is None:
+            self._data = bytearray(self.length)
+        self._data[block.begin:end] = block.data
+        self._received[block_index] = 1
         self.present += len(block.data)
 
+        received = self._received
+        if self._num_hashed < len(received) and received[self._num_hashed]:
+            block_size = self._block_size
+            with memoryview(self._data) as data:
+                while self._num_hashed < len(received) and received[self._num_hashed]:
+                    start = self._num_hashed * block_size
+                    self._sha1.update(data[start:start + block_size])
+                    self._num_hashed += 1
+
     def mark_written(self):
         """
         Marks the piece as written to disk.
@@ -492,6 +539,8 @@ class Piece:
         self.present = self.length
         self._written = True
         self._blocks = []
+        self._received = bytearray()
+        self._data = None
 
     def reset(self):
         """
@@ -500,6 +549,8 @@ class Piece:
         """
         self.present = 0
         self._written = False
+        self._sha1 = hashlib.sha1()
+        self._num_hashed = 0
         self._create_blocks()
 
     def hash(self) -> Optional[bytes]:
@@ -508,20 +559,18 @@ class Piece:
         """
         if self._written or not self.complete:
             return
-        return hashlib.sha1(self.data).digest()
-
-
-MESSAGE_TYPES = {
-    0: Choke,
-    1: Unchoke,
-    2: Interested,
-    3: NotInterested,
-    4: Have,
-    5: Bitfield,
-    6: Request,
-    7: Block,
-    8: Cancel
-}
+        if self._num_hashed != len(self._blocks):
+            return hashlib.sha1(self.data).digest()
+        return self._sha1.digest()
+
+
+# Message types indexed by their message id.
+MESSAGE_TYPES = (Choke, Unchoke, Interested, NotInterested, Have, Bitfield,
+                 Request, Block, Cancel)
+
+# Bound decoders indexed by message id, resolved once at import time so
+# decoding a received message is a single tuple index and call.
+DECODERS = tuple(msg_type.decode for msg_type in MESSAGE_TYPES)
 
 ProtocolMessage = Union[
     Handshake, KeepAlive, Choke, Unchoke, Interested, NotInterested, Have, Bitfield,
@@ -62,7 +62,7 @@ def _validate_torrent_dict(decoded_dict: OrderedDict) -> bool:
     if "info" not in dict_keys or \
         ("announce" not in dict_keys and
          "announce-list" not in dict_keys):
-        logger.error(f"Required key not found.")
+        logger.error("Required key not found.")
         raise MetaInfoCreationError
 
     info_keys: list = list(decoded_dict["info"].keys())
@@ -72,7 +72,7 @@ def _validate_torrent_dict(decoded_dict: OrderedDict) -> bool:
 
     for key in min_info_req_keys:
         if key not in info_keys:
-            logger.error("Required key not found: %s" % key)
+            logger.error("Required key not found: %s", key)
             raise MetaInfoCreationError
 
     if len(decoded_dict["info"]["pieces"]) % 20 != 0:
@@ -91,7 +91,7 @@ def _validate_torrent_dict(decoded_dict: OrderedDict) -> bool:
         for f in file_list:
             for key in min_files_req_keys:
                 if key not in f.keys():
-                    logger.error("Required key not found: %s" % key)
+                    logger.error("Required key not found: %s", key)
                     raise MetaInfoCreationError
     else:
         if "length" not in info_keys:
@@ -117,6 +117,8 @@ class MetaInfoFile:
         self.piece_hashes: list[bytes] = []
         self.pieces: list[Piece] = []
         self.destination: Optional[Path] = None
+        # Index of the first piece that wasn't complete when last checked.
+        self._first_incomplete: int = 0
 
     def __str__(self):
         return f"{self.name}"
@@ -134,11 +136,11 @@ class MetaInfoFile:
         :raises MetaInfoCreationError:
         :return: Torrent instance
         """
-        logger.info("Creating a metainfo object from %s" % filename)
+        logger.info("Creating a metainfo object from %s", filename)
         torrent: MetaInfoFile = cls()
 
         if not os.path.exists(filename):
-            logger.error("Path does not exist %s" % filename)
+            logger.error("Path does not exist %s", filename)
             raise MetaInfoCreationError
 
         torrent.destination = destination
@@ -160,7 +162,7 @@ class MetaInfoFile:
             torrent._collect_pieces()
 
         except (EncodeError, DecodeError, IOError, Exception) as e:
-            logger.debug("Encountered %s in MetaInfoFile.from_file" % type(e).__name__)
+            logger.debug("Encountered %s in MetaInfoFile.from_file", type(e).__name__)
             raise MetaInfoCreationError from e
 
         return torrent
@@ -172,7 +174,7 @@ class MetaInfoFile:
         :param output_filename: The output filename of the torrent
         :raises MetaInfoCreationError:
         """
-        logger.info("Writing .torrent file: %s" % output_filename)
+        logger.info("Writing .torrent file: %s", output_filename)
 
         if not output_filename:
             logger.error("No output filename provided.")
@@ -183,8 +185,8 @@ class MetaInfoFile:
                 data: bytes = Encode(self.meta_info)
                 f.write(data)
             except EncodeError as ee:
-                logger.error("Encountered %s while writing metainfo file %s" %
-                             (type(ee).__name__, output_filename))
+                logger.error("Encountered %s while writing metainfo file %s",
+                             type(ee).__name__, output_filename)
                 raise MetaInfoCreationError from ee
 
     def check_existing_pieces(self) -> None:
@@ -194,6 +196,8 @@ class MetaInfoFile:
         """
         assert self.files
 
+        # Pieces may be reset below, so check them all again afterwards.
+        self._first_incomplete = 0
         fps = {}
         try:
             for i, file in self.files.items():
@@ -203,10 +207,14 @@ class MetaInfoFile:
                 else:
                     fps[i] = None
 
+            file_offsets = [file.offset for file in self.files.values()]
             for i, piece in enumerate(self.pieces):
-                file_index, file_offset = FileItem.file_for_offset(self.files,
-                                                                   i * self.piece_length)
+                located = FileItem.file_for_offset(self.files, i * self.piece_length,
+                                                   file_offsets)
+                if located is None:
+                    continue  # probably raise an error.
 
+                file_index, file_offset = located
                 if file_index not in fps:
                     continue  # probably raise an error.
 
@@ -256,7 +264,7 @@ class MetaInfoFile:
             meta_info["info"]["files"]["length"] is the file's size
             meta_info["info"]["length"] doesn't contribute anything here
         """
-        logger.info("Gathering files for .torrent: %s" % self)
+        logger.info("Gathering files for .torrent: %s", self)
 
         if self.multi_file:
             file_list = self.meta_info["info"]["files"]
@@ -283,7 +291,7 @@ class MetaInfoFile:
         Collects the piece hashes from the metainfo file and
         creates `Piece` objects for each piece.
         """
-        logger.info("Collecting pieces and hashes for .torrent: %s" % self)
+        logger.info("Collecting pieces and hashes for .torrent: %s", self)
         self.piece_hashes = list(_pc(self.meta_info["info"]["pieces"]))
 
         num_pieces = len(self.piece_hashes)
@@ -381,7 +389,21 @@ class MetaInfoFile:
 
     @property
     def complete(self) -> bool:
-        return self.remaining == 0
+        """
+        Checked for every message received from every peer, so this doesn't
+        sum over all the pieces. A completed piece only becomes incomplete
+        again when it fails hash verification, which happens as soon as it's
+        completed, so pieces before the first incomplete one we've already
+        found aren't checked again.
+
+        :return: True if every piece is complete
+        """
+        pieces = self.pieces
+        i = self._first_incomplete
+        while i < len(pieces) and pieces[i].complete:
+            i += 1
+        self._first_incomplete = i
+        return i == len(pieces)
 
     @property
     def num_pieces(self) -> int:
@@ -15,11 +15,12 @@ __all__ = ["PeerConnectionStats", "PeerConnectionPool"]
 import asyncio
 import collections
 import dataclasses
+import socket
 import struct
-from logging import getLogger
+from logging import getLogger, DEBUG, INFO
 from typing import Optional
 
-from .errors import PeerError
+from .errors import PeerError, PeerMessageError
 from .messages import *
 from .metainfo import MetaInfoFile
 from .peer_info import PeerInfo
@@ -27,6 +28,28 @@ from .piece_handler import PieceRequester
 
 logger = getLogger(__name__)
 
+# Maximum number of bytes of queued messages coalesced into a single write.
+_MAX_SEND_BATCH_SIZE = 2 ** 14
+# Maximum number of messages waiting to be sent to a single peer before
+# we stop queueing `Request`s. Other messages carry protocol state and are
+# always queued.
+_MAX_QUEUED_MESSAGES = 64
+# Transport write buffer limits. We only wait for the buffer to drain once
+# it grows past the high-water mark.
+_WRITE_BUFFER_HIGH = 2 ** 16
+_WRITE_BUFFER_LOW = 2 ** 14
+# Largest Block message (id, index and begin, then the data) a peer should send.
+# Frames are otherwise only larger for Bitfields of torrents with many pieces.
+_MAX_BLOCK_FRAME_SIZE = 9 + Block.size
+# Seconds to wait for a connection to a peer, and then for its handshake.
+_CONNECT_TIMEOUT = 10
+# Seconds to wait for a message to send before sending a KeepAlive instead.
+_KEEP_ALIVE_INTERVAL = 60
+# Messages without a payload carry no state, so they share an instance.
+_KEEP_ALIVE = KeepAlive()
+_NO_PAYLOAD_MESSAGES = {msg_type.msg_id: msg_type()
+                        for msg_type in (Choke, Unchoke, Interested, NotInterested)}
+
 
 @dataclasses.dataclass
 class PeerConnectionStats:
@@ -34,6 +57,20 @@ class PeerConnectionStats:
     bytes_downloaded: int = 0
     torrent_bytes_downloaded: int = 0
     torrent_bytes_wasted: int = 0
+    num_connected: int = 0
+
+
+@dataclasses.dataclass
+class PeerConnectionState:
+    """
+    Our side of the protocol state for a single `PeerConnection`.
+    """
+    choking: bool = True
+    interested: bool = False
+
+    def reset(self):
+        self.choking = True
+        self.interested = False
 
 
 class PeerConnectionPool:
@@ -50,6 +87,8 @@ class PeerConnectionPool:
         self.max_num_peers = num_peers
         self.stats = PeerConnectionStats()
         self.requester = PieceRequester(self.torrent, self.stats)
+        self.handshake = Handshake(self.torrent.info_hash,
+                                   self.client_info.peer_id_bytes).encode()
         self.peers: list[Optional[PeerConnection]] = []
         self.piece_queue = piece_queue
 
@@ -64,8 +103,12 @@ class PeerConnectionPool:
 
         self.peers = [
             PeerConnection(self.client_info, self.torrent, self.requester,
-                           self.peer_queue, self.piece_queue, self.stats)
+                           self.peer_queue, self.piece_queue, self.stats,
+                           self.handshake)
             for _ in range(self.max_num_peers)]
+        # Only schedule connections once they've all been fully constructed.
+        for peer in self.peers:
+            peer.start()
 
     def stop(self):
         """
@@ -79,7 +122,7 @@ class PeerConnectionPool:
         """
         :return: The number of currently connected peers.
         """
-        return len([peer for peer in self.peers if peer.peer is not None])
+        return self.stats.num_connected
 
 
 class PeerConnection:
@@ -88,34 +131,65 @@ class PeerConnection:
     """
 
     # TODO: Add support for sending pieces to the peer
-    def __init__(self, local_peer, torrent, requester, peer_queue, piece_queue, stats):
-        self.local = PeerInfo.from_instance(local_peer)
+    def __init__(self, local_peer, torrent, requester, peer_queue, piece_queue, stats,
+                 handshake: bytes):
+        # Our identity is shared between connections; only the state is our own.
+        self.local: PeerInfo = local_peer
+        self.local_state = PeerConnectionState()
         self.torrent = torrent
+        self.handshake = handshake
         self.peer_queue = peer_queue
         self.peer: Optional[PeerInfo] = None
 
         self._requester: PieceRequester = requester
-        self._messages_to_send: asyncio.Queue = asyncio.Queue()
+        self._max_frame_size = _frame_size_limit(torrent.num_pieces)
+        # Only _produce takes messages off the queue, so a deque is enough;
+        # the event wakes it when something's added.
+        self._messages_to_send: collections.deque[ProtocolMessage] = collections.deque()
+        self._messages_queued = asyncio.Event()
         self._completed_pieces: asyncio.Queue = piece_queue
         self._stats = stats
 
-        self.task = asyncio.create_task(self.download(), name="[WAITING] PeerConnection")
+        self.task: Optional[asyncio.Task] = None
+        self._set_name("[WAITING] PeerConnection")
         self._stop_forever = False
         self._last_message_sent = None
         self._last_message_received = None
         self._recently_sent = collections.deque([], maxlen=10)
         self._peer_connected_event = asyncio.Event()
+        self._message_handlers = {
+            Choke: self._on_choke,
+            Unchoke: self._on_unchoke,
+            Have: self._on_have,
+            Bitfield: self._on_bitfield,
+        }
 
     def __str__(self):
-        if not self.peer:
-            return f"{self.task.get_name()}:{self.torrent.info_hash}"
-        return f"{self.task.get_name()}:{self.torrent.info_hash}"
+        return self._name
 
     def __repr__(self):
         return str(self)
 
-    def __eq__(self, other: PeerConnection):
-        return hash(self) == hash(other)
+    def _set_name(self, name: str):
+        """
+        Names the download task and caches our string representation, as
+        it prefixes every message we log.
+
+        :param name: The task's new name.
+        """
+        if self.task:
+            self.task.set_name(name)
+        self._task_name = name
+        self._name = f"{name}:{self.torrent.info_hash}"
+
+    def start(self):
+        """
+        Starts this `PeerConnection` by scheduling its download coroutine
+        on the event loop.
+        """
+        if not self.task:
+            self.task = asyncio.create_task(self.download(),
+                                            name=self._task_name)
 
     def stop_forever(self):
         """
@@ -129,191 +203,301 @@ class PeerConnection:
     async def download(self):
         """
         This coroutine is scheduled as a task when the `PeerConnection` is
-        initialized. It is responsible for consuming a peer connection from
+        started. It is responsible for consuming a peer connection from
         the queue and exchanging BitTorrent protocol messages with that queue.
         The `PeerConnection` will reset itself on any error until its
         been told to stop forever.
         """
         while not self._stop_forever:
             tasks = []
-            reader, writer = None, None
-            received_msg_q = asyncio.Queue()
+            stream = None
             try:
                 peer_info = await self.peer_queue.get()
                 if not peer_info or self._stop_forever:
                     continue
 
                 self.peer = peer_info
-                self.task.set_name(f"{self.peer}")
+                self._stats.num_connected += 1
+                self._set_name(str(self.peer))
 
-                logger.info("%s: Opening connection with peer." % self)
+                logger.info("%s: Opening connection with peer.", self)
                 # TODO: When we start allowing peers to connect to us,
                 #       we'll need to listen on a socket rather than
                 #       just connecting with the peer.
-                reader, writer = await open_connection(peer_info.ip, peer_info.port)
-                if not await self.negotiate_handshake(reader, writer):
+                # Don't let an unresponsive peer hold on to this connection.
+                stream = await asyncio.wait_for(
+                    open_connection(peer_info.ip, peer_info.port,
+                                    self._max_frame_size),
+                    timeout=_CONNECT_TIMEOUT)
+                if not await asyncio.wait_for(self.negotiate_handshake(stream),
+                                              timeout=_CONNECT_TIMEOUT):
                     continue
 
                 if self._stop_forever:
                     continue
 
-                tasks.append(asyncio.create_task(read_messages_task(reader,
-                                                                    received_msg_q,
-                                                                    self._stats),
-                                                 name=f"{self}:read"))
-                tasks.append(asyncio.create_task(self._produce(writer),
+                tasks.append(asyncio.create_task(self._produce(stream),
                                                  name=f"{self}:produce"))
-                tasks.append(asyncio.create_task(self._consume(received_msg_q),
+                tasks.append(asyncio.create_task(self._consume(stream),
                                                  name=f"{self}:consume"))
                 tasks.append(asyncio.create_task(self._monitor_connection(),
                                                  name=f"{self}:monitor"))
-                await asyncio.gather(*tasks)
+
+                # Any task finishing means the connection is done; don't wait
+                # on the others; they're cancelled below.
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if not t.cancelled() and t.exception():
+                        raise t.exception()
             except Exception as exc:
-                logger.error("%s: %s received in download." % (self, type(exc).__name__))
+                logger.error("%s: %s received in download.", self, type(exc).__name__)
             except BaseException as bexc:
-                logger.error("%s: %s received in download." % (self, type(bexc).__name__))
+                logger.error("%s: %s received in download.", self, type(bexc).__name__)
                 self._stop_forever = True
             finally:
-                logger.info("%s: Closing connection with peer." % self)
-                if self.peer:
-                    self._requester.remove_peer(self.peer)
-                self.peer = None
-                await close_connection(writer)
-
+                logger.info("%s: Closing connection with peer.", self)
+                # Stop using the connection before closing it.
                 for t in tasks:
                     if not t.done():
                         t.cancel()
 
                 await asyncio.gather(*tasks, return_exceptions=True)
 
+                if self.peer:
+                    self._requester.remove_peer(self.peer)
+                    self._stats.num_connected -= 1
+                self.peer = None
+                if stream:
+                    await close_connection(stream)
+
                 if not self._stop_forever:
-                    logger.info("%s: Resetting peer connection." % self)
-                    self.local.reset_state()
-                    self._messages_to_send = asyncio.Queue()
+                    logger.info("%s: Resetting peer connection.", self)
+                    self.local_state.reset()
+                    self._messages_to_send.clear()
                     self._last_message_sent = None
-                    self._recently_sent = collections.deque([], maxlen=10)
-                    self.task.set_name("[WAITING] PeerConnection")
+                    self._recently_sent.clear()
+                    self._set_name("[WAITING] PeerConnection")
 
-        logger.debug("%s: Stopped forever" % self)
+        logger.debug("%s: Stopped forever", self)
 
     async def _monitor_connection(self):
         """
         Monitors the health of this peer connection, sending
-        KeepAlive and resending stale Requests.
+        KeepAlive and resending stale Requests. Also tops up our Requests
+        when another peer releases theirs.
         """
-        started_at = asyncio.get_event_loop().time()
+        time = asyncio.get_running_loop().time
+        started_at = time()
         num_keep_alive = 0
         max_keep_alive = 2
         check_requests = True
+        released: Optional[asyncio.Task] = None
 
-        while not self._stop_forever:
-            if not self.peer:
-                break
-
-            now = asyncio.get_event_loop().time()
-
-            # No messages sent or received yet, sleep for now.
-            if not self._last_message_sent or not self._last_message_received:
-                if now - started_at >= 10:
-                    raise PeerError("%s: No messages exchanged with peer for 10 "
-                                    "seconds." % self)
-                await asyncio.sleep(.5)
-                continue
-
-            last_msg_diff = now - self._last_message_sent
-            keep_alive_diff = now - self._last_message_received
-            if keep_alive_diff >= 30:
-                num_keep_alive += 1
-                if num_keep_alive >= max_keep_alive:
-                    raise PeerError("%s: Sent 2 KeepAlives with no response. Closing "
-                                    "connection." % self)
-                asyncio.create_task(self._messages_to_send.put(KeepAlive()))
-
-            if last_msg_diff >= 2 and check_requests:
-                added = False
-                outstanding = self._requester.peer_outstanding_requests(self.peer)
-                if self.local.interested and outstanding:
-                    logger.debug(
-                        "%s: Last message sent to the peer > 2 seconds ago. "
-                        "Attempting to resend outstanding requests." % self)
-                    for msg in outstanding:
-                        if isinstance(msg, Request) and msg.is_stale(now):
-                            msg.num_retries += 1
-                            if msg.num_retries >= 6:
-                                if msg.num_retries == 6:
-                                    logger.debug(
-                                        "%s: Retried request max # of times." % self)
-                                continue
-                            asyncio.create_task(self._messages_to_send.put(msg))
-                            added = True
-
-                    if not added:
-                        check_requests = False
-            await asyncio.sleep(.5)
-
-    async def _consume(self, received_msg_q: asyncio.Queue):
-        """
-        Iterates through messages we've received from the peer after the
-        initial handshake, updating state, queuing up responses, and
-        handling downloaded blocks as appropriate.
-
-        :param received_msg_q: Queue from which to read received messages.
-
-        :raises PeerError: on any exception
+        try:
+            while not self._stop_forever:
+                if not self.peer:
+                    break
+
+                now = time()
+
+                # No messages sent or received yet, sleep for now.
+                if not self._last_message_sent or not self._last_message_received:
+                    if now - started_at >= 10:
+                        raise PeerError("%s: No messages exchanged with peer for 10 "
+                                        "seconds." % self)
+                    await asyncio.sleep(.5)
+                    continue
+
+                last_msg_diff = now - self._last_message_sent
+                keep_alive_diff = now - self._last_message_received
+                if keep_alive_diff >= 30:
+                    num_keep_alive += 1
+                    if num_keep_alive >= max_keep_alive:
+                        raise PeerError("%s: Sent 2 KeepAlives with no response. Closing "
+                                        "connection." % self)
+                    self._queue_message(_KEEP_ALIVE)
+
+                if last_msg_diff >= 2 and check_requests:
+                    added = False
+                    outstanding = self._requester.peer_outstanding_requests(self.peer)
+                    if self.local_state.interested and outstanding:
+                        logger.debug(
+                            "%s: Last message sent to the peer > 2 seconds ago. "
+                            "Attempting to resend outstanding requests.", self)
+                        for msg in outstanding:
+                            if isinstance(msg, Request) and msg.is_stale(now):
+                                msg.num_retries += 1
+                                if msg.num_retries >= 6:
+                                    if msg.num_retries == 6:
+                                        logger.debug(
+                                            "%s: Retried request max # of times.", self)
+                                    continue
+                                if self._queue_message(msg):
+                                    added = True
+
+                        if not added:
+                            check_requests = False
+
+                if released is None and (self.peer.choking
+                                         or not self.local_state.interested):
+                    # Released requests are no use until we can send requests,
+                    # so don't get woken for them.
+                    await asyncio.sleep(.5)
+                    continue
+
+                # The same wait carries over between checks until requests are
+                # released, rather than starting a new one every time.
+                if released is None:
+                    released = asyncio.create_task(self._requester.requests_released())
+                done, _ = await asyncio.wait((released,), timeout=.5)
+                if not done:
+                    continue
+                released = None
+                if self.peer and not self.peer.choking and self.local_state.interested:
+                    self._queue_requests()
+        finally:
+            if released is not None:
+                released.cancel()
+
+    async def _consume(self, stream: PeerStream):
+        """
+        Reads messages from the peer after the initial handshake, updating
+        state, queuing up responses, and handling downloaded blocks as
+        appropriate.
+
+        :param stream: `PeerStream` to read messages from.
+
+        :raises PeerError: on any exception other than the peer closing
+                           the connection or a handler returning True
+                           to end it.
         """
+        # Resolved once per connection rather than once per message.
+        stats = self._stats
+        torrent = self._requester.torrent
+        get_handler = self._message_handlers.get
+        on_block = self._on_block
+        time = asyncio.get_running_loop().time
+        log_messages = logger.isEnabledFor(INFO)
+
         try:
             while not self._stop_forever:
-                if not received_msg_q:
-                    raise PeerError("%s: No received message queue." % self)
+                try:
+                    msg = await _receive_from_peer(stream, stats)
+                except PeerMessageError as exc:
+                    # Skip the message; no need to drop the connection over it.
+                    logger.info("%s: Ignoring message: %s", self, exc)
+                    continue
+
+                if msg is None:
+                    logger.info("%s: Peer closed the connection.", self)
+                    return
 
-                msg = await received_msg_q.get()
-                if self._stop_forever or self._requester.torrent.complete:
+                if self._stop_forever or torrent.complete:
                     # TODO: don't stop forever if we're complete.
                     #       We may want to continue seeding.
                     #       at minimum, lose interest in the peer.
                     break
 
-                logger.info("%s: Sent %s" % (self, msg))
-                self._last_message_received = asyncio.get_event_loop().time()
-
-                if isinstance(msg, Choke):
-                    self.peer.choking = True
-                    self._requester.remove_requests_for_peer(self.peer)
-                    # Decide if we should only purge requests?
-                elif isinstance(msg, Unchoke):
-                    self.peer.choking = False
-                    if self.local.interested:
-                        if not self._requester.fill_peer_request_queue(self.peer,
-                                                                       self._messages_to_send):
-                            logger.debug("%s: Unchoked us and we're interested, "
-                                         "but we don't have any requests to send.")
-                            raise PeerError
-                elif isinstance(msg, Have):
-                    self._requester.add_available_piece(self.peer, msg.index)
-                    if self._requester.peer_is_interesting(self.peer):
-                        if not self.local.interested:
-                            asyncio.create_task(self._messages_to_send.put(Interested()))
-                elif isinstance(msg, Bitfield):
-                    self._requester.add_peer_bitfield(self.peer, msg.bitfield)
-                    if self._requester.peer_is_interesting(self.peer):
-                        if not self.local.interested:
-                            asyncio.create_task(self._messages_to_send.put(Interested()))
-                elif isinstance(msg, Block):
-                    piece = self._requester.peer_received_block(msg, self.peer)
-                    if piece:
-                        self._piece_complete(piece.index)
-
-                    if self.torrent.complete:
-                        self.stop_forever()
-                        break
-
-                    if not self._requester.fill_peer_request_queue(self.peer,
-                                                                   self._messages_to_send):
-                        logger.debug("%s: No more requests for peer." % self.peer)
-                        # raise PeerError
+                if log_messages:
+                    logger.info("%s: Sent %s", self, msg)
+                self._last_message_received = time()
+
+                msg_type = type(msg)
+                if msg_type is Block:
+                    # Nearly everything a peer sends us is a Block.
+                    on_block(msg)
+                    continue
+
+                handler = get_handler(msg_type)
+                if handler and handler(msg):
+                    # Nothing more to do with this peer.
+                    return
+        except PeerError:
+            raise
         except Exception as exc:
             raise PeerError from exc
 
+    def _on_choke(self, _: Choke):
+        self.peer.choking = True
+        self._requester.remove_requests_for_peer(self.peer)
+        self._drop_queued_requests()
+
+    def _on_unchoke(self, _: Unchoke) -> bool:
+        self.peer.choking = False
+        if self.local_state.interested:
+            if not self._queue_requests():
+                logger.info("%s: Unchoked us and we're interested, "
+                            "but we don't have any requests to send.", self)
+                return True
+        return False
+
+    def _on_have(self, msg: Have):
+        self._requester.add_available_piece(self.peer, msg.index)
+        if self._requester.peer_is_interesting(self.peer):
+            if not self.local_state.interested:
+                self._queue_message(Interested())
+
+    def _on_bitfield(self, msg: Bitfield):
+        self._requester.add_peer_bitfield(self.peer, msg.bitfield)
+        if self._requester.peer_is_interesting(self.peer):
+            if not self.local_state.interested:
+                self._queue_message(Interested())
+
+    def _on_block(self, msg: Block):
+        # Called for every block received, so look everything up once.
+        requester = self._requester
+        peer = self.peer
+
+        piece = requester.peer_received_block(msg, peer)
+        if piece:
+            self._piece_complete(piece.index)
+
+        if self.torrent.complete:
+            self.stop_forever()
+            return
+
+        if not self._queue_requests():
+            logger.debug("%s: No more requests for peer.", peer)
+            # raise PeerError
+
+    def _queue_message(self, msg: ProtocolMessage) -> bool:
+        """
+        Queues a message to be sent to the peer without waiting.
+        `Request`s are dropped once the queue is full, as they'll be retried;
+        every other message is always queued.
+
+        :param msg: The message to send.
+        :return: True if queued, False if the queue is full and the message was dropped.
+        """
+        if (isinstance(msg, Request)
+                and len(self._messages_to_send) >= _MAX_QUEUED_MESSAGES):
+            logger.debug("%s: Send queue full, dropping %s", self, msg)
+            return False
+        self._messages_to_send.append(msg)
+        self._messages_queued.set()
+        return True
+
+    def _queue_requests(self) -> bool:
+        """
+        Tops up the `Request`s waiting to be sent to the peer.
+
+        :return: True if any requests were queued, False otherwise.
+        """
+        if self._requester.fill_peer_request_queue(self.peer, self._messages_to_send,
+                                                   _MAX_QUEUED_MESSAGES):
+            self._messages_queued.set()
+            return True
+        return False
+
+    def _drop_queued_requests(self):
+        """
+        Removes any `Request`s still waiting to be sent to the peer.
+        Called when the peer chokes us, as they'll be ignored.
+        """
+        queued = [msg for msg in self._messages_to_send if not isinstance(msg, Request)]
+        self._messages_to_send.clear()
+        self._messages_to_send.extend(queued)
+
     def _piece_complete(self, piece_index):
         """
         Called when the last block of a piece has been received.
@@ -326,84 +510,122 @@ class PeerConnection:
         if not piece.complete:
             return
         asyncio.create_task(self._completed_pieces.put(piece))
-        asyncio.create_task(self._messages_to_send.put(Have(piece.index)))
+        self._queue_message(Have(piece.index))
 
-    async def _produce(self, writer):
+    async def _produce(self, stream: PeerStream):
         """
         Sends messages to the peer as they become available in the message
         queue. We wait 60 seconds when trying to send the next message. If we
         don't get a message in those 60 seconds, we send a KeepAlive.
+        Messages that are already queued are sent together in one write.
 
         :raises PeerError: on any exception.
         """
+        writelines = stream.writelines
+        time = asyncio.get_running_loop().time
+        queue = self._messages_to_send
+        queued = self._messages_queued
         while not self._stop_forever:
             try:
-                msg = await self._messages_to_send.get()
+                if not queue:
+                    # Wait for something to send until a KeepAlive is due.
+                    queued.clear()
+                    timeout = _KEEP_ALIVE_INTERVAL
+                    if self._last_message_sent:
+                        timeout -= time() - self._last_message_sent
+                    try:
+                        await asyncio.wait_for(queued.wait(), timeout=max(timeout, 0))
+                    except asyncio.TimeoutError:
+                        pass
+                    else:
+                        if not queue:
+                            # Everything queued was dropped before we woke.
+                            continue
                 if self._stop_forever:
                     break
 
-                if isinstance(msg, Interested):
-                    if self.local.interested:
-                        msg = None
-                    self.local.interested = True
-                elif isinstance(msg, NotInterested):
-                    self.local.interested = False
-                elif isinstance(msg, Request):
-                    msg.requested_at = asyncio.get_event_loop().time()
-
-                if msg:
-                    logger.debug("%s: Sending %s to %s" % (self.local, msg, self.peer))
-
-                    data = msg.encode()
-                    if not data:
-                        raise PeerError("No data encoded.")
-
-                    writer.write(data)
-                    self._stats.bytes_uploaded += len(data)
-                    self._last_message_sent = asyncio.get_event_loop().time()
-                    self._recently_sent.append(msg)
-                    asyncio.create_task(writer.drain())
-
-                self._messages_to_send.task_done()
+                # Everything in this batch is sent at the same time.
+                now = time()
+                if not queue:
+                    frames = [self._prepare_to_send(_KEEP_ALIVE, now)]
+                    size = len(frames[0])
+                else:
+                    # Send anything else already queued in the same write.
+                    frames = []
+                    size = 0
+                    while queue and size < _MAX_SEND_BATCH_SIZE:
+                        encoded = self._prepare_to_send(queue.popleft(), now)
+                        if encoded:
+                            frames.append(encoded)
+                            size += len(encoded)
+
+                if frames:
+                    writelines(frames)
+                    self._stats.bytes_uploaded += size
+                    self._last_message_sent = now
+                    if stream.transport.get_write_buffer_size() > _WRITE_BUFFER_HIGH:
+                        await stream.drain()
             except Exception as exc:
                 raise PeerError from exc
 
-    async def negotiate_handshake(self,
-                                  reader: asyncio.StreamReader,
-                                  writer: asyncio.StreamWriter) -> bool:
+    def _prepare_to_send(self, msg: ProtocolMessage, now: float) -> Optional[bytes]:
+        """
+        Updates our state for a message about to be sent to the peer
+        and encodes it.
+
+        :param msg: The message to send.
+        :param now: The event loop's time when the message is sent.
+        :return: The encoded message, or None if it doesn't need to be sent.
+        :raises PeerError: if the message can't be encoded.
+        """
+        # Nearly everything we send is a Request, so check for those first.
+        msg_type = type(msg)
+        if msg_type is Request:
+            msg.requested_at = now
+        elif msg_type is Interested:
+            if self.local_state.interested:
+                return
+            self.local_state.interested = True
+        elif msg_type is NotInterested:
+            self.local_state.interested = False
+
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("%s: Sending %s to %s", self.local, msg, self.peer)
+
+        data = msg.encode()
+        if not data:
+            raise PeerError("No data encoded.")
+
+        self._recently_sent.append(msg)
+        return data
+
+    async def negotiate_handshake(self, stream: PeerStream) -> bool:
         """
         Negotiates the handshake with the peer.
 
-        :param reader: `StreamReader` to read the handshake from.
-        :param writer: `StreamWriter` to write the handshake to
+        :param stream: `PeerStream` to exchange the handshake over.
 
         :return: True if the handshake is successful, False otherwise
         """
         if self._stop_forever:
             return False
 
-        logger.info("%s: Negotiating handshake." % self)
-        sent_handshake = Handshake(self.torrent.info_hash,
-                                   self.local.peer_id_bytes).encode()
-        if not sent_handshake:
-            return False
-        writer.write(sent_handshake)
-        self._stats.bytes_uploaded += len(sent_handshake)
-        await writer.drain()
-
-        if self._stop_forever:
+        logger.info("%s: Negotiating handshake.", self)
+        if not self.handshake:
             return False
+        # No need to drain; the handshake alone never fills the write buffer.
+        stream.write(self.handshake)
+        self._stats.bytes_uploaded += len(self.handshake)
 
-        received_handshake = await receive_handshake(reader, self._stats)
+        received_handshake = await receive_handshake(stream, self._stats)
 
         if not received_handshake:
-            logger.error("%s: Unable to initiate handshake." % self)
+            logger.error("%s: Unable to initiate handshake.", self)
             return False
 
         if received_handshake.info_hash != self.torrent.info_hash:
-            logger.error("%s: Wrong info hash. Expected: %s\tReceived: %s" % (
-                self, self.torrent.info_hash,
-                received_handshake.info_hash))
+            logger.error("%s: Wrong info hash. Expected: %s\tReceived: %s",
+                         self, self.torrent.info_hash, received_handshake.info_hash)
             return False
 
         if received_handshake.peer_id:
@@ -411,43 +633,292 @@ class PeerConnection:
         return True
 
 
-async def open_connection(host: str, port: int) -> [asyncio.StreamReader,
-                                                    asyncio.StreamWriter]:
+class PeerStream(asyncio.BufferedProtocol):
     """
-    A wrapper for asyncio.open_connection() returning a (reader, writer) pair.
+    A connection with a peer.
 
-    :param host: hostname of the peer
-    :param port: port to connect to
+    Data received from the peer is read directly into a preallocated buffer
+    that's reused for the lifetime of the connection, rather than allocating
+    new `bytes` for every read from the socket and copying them into a growing
+    buffer like `asyncio.StreamReader` does.
+    """
+    buffer_size = 2 ** 18
+    length_fmt = struct.Struct(">I")
+
+    def __init__(self, max_frame_size: int = _MAX_BLOCK_FRAME_SIZE):
+        """
+        :param max_frame_size: the largest message the peer may send, not
+                               counting its length prefix.
+        """
+        self.transport: Optional[asyncio.Transport] = None
+        self.max_frame_size = max_frame_size
+        self._loop = asyncio.get_running_loop()
+        self._buffer = bytearray(self.buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first unread byte
+        self._end = 0  # one past the last received byte
+        self._eof = False
+        self._exception: Optional[Exception] = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self._read_waiter: Optional[asyncio.Future] = None
+        self._drain_waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._closed = self._loop.create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            # Move any unread data to the front to make room at the end.
+            # It's copied first, as it can overlap where it's moved to.
+            unread = self._end - self._start
+            self._buffer[:unread] = bytes(self._view[self._start:self._end])
+            self._start, self._end = 0, unread
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+        if self._start == 0 and self._end == len(self._buffer):
+            # Full of data nobody has read yet.
+            self.transport.pause_reading()
+            self._reading_paused = True
+        self._wake(self._read_waiter)
+
+    def eof_received(self):
+        self._eof = True
+        self._wake(self._read_waiter)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        self._eof = True
+        if exc is not None:
+            self._exception = exc
+        self._writing_paused = False
+        self._wake(self._read_waiter)
+        self._wake_drain_waiters()
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        self._wake_drain_waiters()
+
+    def _wake_drain_waiters(self):
+        for waiter in self._drain_waiters:
+            self._wake(waiter)
+
+    @staticmethod
+    def _wake(waiter: Optional[asyncio.Future]):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def at_eof(self) -> bool:
+        """
+        :return: True if the peer closed the connection and everything
+                 they sent has been read.
+        """
+        return self._eof and self._start == self._end
 
-    :returns: `StreamReader` and `StreamWriter` instances to read and send messages.
+    def exception(self) -> Optional[Exception]:
+        """
+        :return: The exception the connection was lost with, if any.
+        """
+        return self._exception
+
+    async def readexactly(self, n: int) -> bytes:
+        """
+        Reads exactly `n` bytes from the peer.
+
+        :param n: number of bytes to read.
+        :return: the data read.
+        :raises `asyncio.IncompleteReadError`: if the peer closes the
+                                              connection before `n` bytes are read.
+        """
+        await self._wait_for(n)
+        data = bytes(self._view[self._start:self._start + n])
+        self._advance(n)
+        return data
+
+    async def readframe(self) -> Optional[memoryview]:
+        """
+        Reads the next length-prefixed message from the peer.
+        The message isn't copied out of the buffer, so the view returned is
+        only valid until the next read or until control returns to the event
+        loop and more data is received. We only wait on the peer when the
+        whole message hasn't been received yet.
+
+        :return: a view of the message without its length prefix, or None if
+                 the peer closed the connection between messages.
+        :raises `asyncio.IncompleteReadError`: if the peer closes the
+                                              connection partway through a message.
+        :raises `PeerError`: if the message is larger than `max_frame_size`.
+        """
+        if self._end - self._start < 4:
+            try:
+                await self._wait_for(4)
+            except asyncio.IncompleteReadError as e:
+                if not e.partial:
+                    return
+                raise
+
+        msg_len, = self.length_fmt.unpack_from(self._buffer, self._start)
+        # Checked before waiting so the peer can't make us grow the buffer
+        # to whatever size it claims.
+        if msg_len > self.max_frame_size:
+            raise PeerError("Message of %s bytes is larger than the maximum of %s."
+                            % (msg_len, self.max_frame_size))
+        if self._end - self._start - 4 < msg_len:
+            await self._wait_for(4 + msg_len)
+
+        start = self._start + 4
+        self._advance(4 + msg_len)
+        return self._view[start:start + msg_len]
+
+    async def _wait_for(self, n: int):
+        """
+        Waits until at least `n` unread bytes are in the buffer.
+
+        :raises `asyncio.IncompleteReadError`: if the peer closes the
+                                              connection first.
+        """
+        if n > len(self._buffer):
+            self._grow(n)
+
+        while self._end - self._start < n:
+            if self._exception is not None:
+                raise self._exception
+            if self._eof:
+                partial = bytes(self._view[self._start:self._end])
+                self._start = self._end
+                raise asyncio.IncompleteReadError(partial, n)
+            if self._reading_paused:
+                self._reading_paused = False
+                self.transport.resume_reading()
+
+            self._read_waiter = self._loop.create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+
+    def _advance(self, n: int):
+        """
+        Marks `n` bytes at the front of the buffer as read.
+        """
+        self._start += n
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def _grow(self, size: int):
+        """
+        Replaces the receive buffer with one that can hold at least `size` bytes.
+        Only happens when the peer sends a message larger than the buffer.
+        """
+        unread = self._end - self._start
+        buffer = bytearray(max(size, 2 * len(self._buffer)))
+        buffer[:unread] = self._view[self._start:self._end]
+        self._buffer, self._view = buffer, memoryview(buffer)
+        self._start, self._end = 0, unread
+
+    def write(self, data: bytes):
+        self.transport.write(data)
+
+    def writelines(self, frames: list[bytes]):
+        """
+        Writes several messages at once. The transport can send them with a
+        single `sendmsg` call without joining them first.
+        """
+        self.transport.writelines(frames)
+
+    async def drain(self):
+        """
+        Waits until the transport's write buffer is below its low-water mark.
+        """
+        if self._exception is not None:
+            raise self._exception
+        if self._closed.done():
+            raise ConnectionResetError("Connection lost")
+        if not self._writing_paused:
+            return
+        # Each caller waits on its own future so concurrent drains all wake.
+        waiter = self._loop.create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            self._drain_waiters.remove(waiter)
+        if self._closed.done():
+            raise ConnectionResetError("Connection lost")
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await asyncio.shield(self._closed)
+
+
+def _frame_size_limit(num_pieces: int) -> int:
+    """
+    :param num_pieces: number of pieces in the torrent.
+    :return: the largest message a peer may send for the torrent, not
+             counting its length prefix.
+    """
+    return max(_MAX_BLOCK_FRAME_SIZE, 1 + (num_pieces + 7) // 8)
+
+
+async def open_connection(host: str, port: int,
+                          frame_size: int = _MAX_BLOCK_FRAME_SIZE) -> PeerStream:
     """
-    loop = asyncio.events.get_event_loop()
-    reader = asyncio.StreamReader(loop=loop)
-    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
-    transport, _ = await loop.create_connection(
-        lambda: protocol, host, port)
-    transport.set_write_buffer_limits(0)  # let the OS handle buffering
-    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
-    return reader, writer
+    Opens a connection with the peer.
 
+    :param host: hostname of the peer
+    :param port: port to connect to
+    :param frame_size: the largest message the peer may send
 
-async def close_connection(writer: asyncio.StreamWriter):
+    :returns: `PeerStream` to read and send messages.
     """
-    Closes the `StreamWriter`
+    loop = asyncio.get_running_loop()
+    transport, stream = await loop.create_connection(
+        lambda: PeerStream(frame_size), host, port)
+    transport.set_write_buffer_limits(high=_WRITE_BUFFER_HIGH, low=_WRITE_BUFFER_LOW)
+
+    # Don't let Nagle's algorithm hold back small messages like Requests
+    # while waiting on the ACK for a previous write.
+    # The kernel's socket buffer sizes are left alone; setting them
+    # explicitly disables Linux's buffer autotuning.
+    sock = transport.get_extra_info("socket")
+    if sock is not None:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return stream
+
+
+async def close_connection(stream: PeerStream):
+    """
+    Closes the connection with the peer.
 
-    :param writer: the `StreamWriter` to close.
+    :param stream: the `PeerStream` to close.
     """
-    await writer.drain()
-    writer.close()
-    await writer.wait_closed()
+    try:
+        await stream.drain()
+    except OSError:
+        # The connection is already gone; there's nothing to flush.
+        pass
+    stream.close()
+    await stream.wait_closed()
 
 
-async def receive_handshake(reader: asyncio.StreamReader,
+async def receive_handshake(reader: PeerStream,
                             stats: PeerConnectionStats = None) -> Optional[Handshake]:
     """
     Receives and decodes the handshake message sent by the peer.
 
-    :param reader: `asyncio.StreamReader` to read handshake from.
+    :param reader: `PeerStream` to read handshake from.
     :param stats: `PeerConnectionStats` to populate data into.
 
     :return: Decoded `Handshake` if successfully read, otherwise None.
@@ -464,59 +935,43 @@ async def receive_handshake(reader: asyncio.StreamReader,
     return Handshake.decode(data)
 
 
-async def read_messages_task(reader: asyncio.StreamReader,
-                             received_msg_queue: asyncio.Queue,
-                             download_stats: PeerConnectionStats = None):
-    """
-    Coroutine intended to be scheduled as a task that will continually
-    read messages from the peer and populate them into the given queue.
-
-    :param reader: `StreamReader` to read from.
-    :param received_msg_queue: `Queue` to place messages into.
-    :param download_stats: Optional `PeerConnectionStatus` object to populate stats into.
-    """
-    while True:
-        received = await _receive_from_peer(reader, download_stats)
-        if received:
-            asyncio.create_task(received_msg_queue.put(received))
-
-
-async def _receive_from_peer(reader: asyncio.StreamReader,
-                             stats: PeerConnectionStats) -> ProtocolMessage:
+async def _receive_from_peer(reader: PeerStream,
+                             stats: PeerConnectionStats) -> Optional[ProtocolMessage]:
     """
     Receives and decodes the next message sent by the peer.
 
-    :param reader: `StreamReader` to read from.
+    :param reader: `PeerStream` to read from.
     :param stats: `PeerConnectionStats` to update.
 
-    :return: The specific instance of the `ProtocolMessage` received.
-    :raises `PeerError`: on exception or if disconnected.
+    :return: The specific instance of the `ProtocolMessage` received, or None
+             if the peer closed the connection.
+    :raises `PeerMessageError`: if the message can't be decoded.
+    :raises `PeerError`: on any other exception or if disconnected mid-message.
     """
     assert reader is not None
 
-    if reader.at_eof() or reader.exception():
-        raise PeerError("Cannot receive message on disconnected reader.")
-
+    # A disconnected reader is caught by the read itself; the stream's
+    # state is checked once in receive_handshake.
     try:
-        msg_len = struct.unpack(">I", await reader.readexactly(4))[0]
-        stats.bytes_downloaded += 4
-
-        if msg_len == 0:
-            return KeepAlive()
-
-        msg_id = struct.unpack(">B", await reader.readexactly(1))[0]
-        if msg_id is None or (not (0 <= msg_id <= 8)):
-            raise PeerError("Unknown message received: %s" % msg_id)
+        msg_data = await reader.readframe()
+    except PeerError:
+        raise
+    except Exception as e:
+        raise PeerError from e
 
-        # the msg_len includes 1 byte for the id
-        msg_len -= 1
-        if msg_len == 0:
-            return MESSAGE_TYPES[msg_id].decode()
+    if msg_data is None:
+        return
 
-        msg_data = await reader.readexactly(msg_len)
-        if stats:
-            stats.bytes_downloaded += msg_len
+    msg_len = len(msg_data)
+    stats.bytes_downloaded += 4 + msg_len
+    if msg_len == 0:
+        return _KEEP_ALIVE
 
-        return MESSAGE_TYPES[msg_id].decode(msg_data)
+    msg_id = msg_data[0]
+    try:
+        if msg_len == 1:
+            return _NO_PAYLOAD_MESSAGES[msg_id]
+        # msg_data is a view of the stream's buffer; decoders copy what they keep.
+        return DECODERS[msg_id](msg_data[1:])
     except Exception as e:
-        raise PeerError from e
+        raise PeerMessageError("Unable to decode message with id %s." % msg_id) from e
@@ -8,12 +8,18 @@ from typing import Optional
 
 
 class PeerInfo:
+    __slots__ = ("ip", "port", "_peer_id", "choking", "interested", "_str", "_hash")
+
     def __init__(self, ip: str, port: int, peer_id: Optional[bytes] = None):
         self.ip: str = ip
         self.port: int = port
         self._peer_id: Optional[bytes] = peer_id
         self.choking = True
         self.interested = False
+        # Peers are used as dictionary keys and logged throughout,
+        # and ip/port never change.
+        self._str: str = f"{ip}:{port}"
+        self._hash: int = hash((ip, port))
 
     def __eq__(self, other):
         # TODO: check equality across info hashes
@@ -22,10 +28,10 @@ class PeerInfo:
                 and self.port == other.port)
 
     def __str__(self):
-        return f"{self.ip}:{self.port}"
+        return self._str
 
     def __hash__(self):
-        return hash(str(self))
+        return self._hash
 
     def reset_state(self):
         self.choking = True
@@ -36,13 +42,12 @@ class PeerInfo:
         return cls(other.ip, other.port, other.peer_id_bytes)
 
     @property
-    def peer_id_bytes(self) -> bytes:
-        if self._peer_id:
-            return self._peer_id
+    def peer_id_bytes(self) -> Optional[bytes]:
+        return self._peer_id
 
     @property
     def peer_id(self) -> str:
-        return str(self)
+        return self._str
 
     @peer_id.setter
     def peer_id(self, val):
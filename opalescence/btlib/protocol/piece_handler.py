@@ -7,9 +7,9 @@ Contains the logic for requesting pieces, as well as that for writing them to di
 __all__ = ['PieceRequester']
 
 import asyncio
-import dataclasses
 import logging
-from collections import defaultdict
+import time
+from collections import defaultdict, deque
 from typing import Optional
 
 import bitstring
@@ -21,11 +21,34 @@ from .peer_info import PeerInfo
 
 logger = logging.getLogger(__name__)
 
+# Every possible bitfield byte expanded to one byte per bit, most
+# significant bit first.
+_EXPANDED_BITS = tuple(bytes((byte >> (7 - bit)) & 1 for bit in range(8))
+                       for byte in range(256))
 
-@dataclasses.dataclass
-class WriteBuffer:
-    buffer = b''
-    offset = 0
+
+def _has_all_pieces(bitfield: bytes, num_pieces: int) -> bool:
+    """
+    :return: True if the bitfield has a bit set for every one of the pieces.
+    """
+    full_bytes, spare_bits = divmod(num_pieces, 8)
+    if bitfield.count(0xff, 0, full_bytes) != full_bytes:
+        return False
+    if not spare_bits:
+        return True
+    last_bits = (1 << spare_bits) - 1
+    return (len(bitfield) > full_bytes
+            and bitfield[full_bytes] >> (8 - spare_bits) == last_bits)
+
+
+def _set_indices(flags: bytes):
+    """
+    Yields the index of each byte that's 1 in a byte-per-piece bitmap.
+    """
+    i = flags.find(1)
+    while i != -1:
+        yield i
+        i = flags.find(1, i + 1)
 
 
 class PieceRequester:
@@ -34,40 +57,94 @@ class PieceRequester:
     A single requester is shared between all peers to which
     the local peer is connected.
 
-    We currently use a naive sequential requesting strategy.
+    We request the rarest pieces first, finishing pieces we've already
+    started before moving on to new ones.
     """
     _block_size = 2 ** 14
+    _max_outstanding_requests = 10
+    # Minimum number of seconds between reordering requests by rarity.
+    _reorder_interval = 1
 
     def __init__(self, torrent: MetaInfoFile, stats):
         self.torrent = torrent
 
-        # dictionary of peers and indices of the pieces the peer has available
-        self.peer_piece_map: dict[PeerInfo, set[int]] = defaultdict(set)
+        # dictionary of peers and the pieces the peer has available,
+        # with a byte per piece that's 1 if the peer has it and 0 otherwise
+        self.peer_piece_map: dict[PeerInfo, bytearray] = defaultdict(
+            lambda: bytearray(torrent.num_pieces))
+
+        # number of connected peers that have each piece
+        self._piece_availability: list[int] = [0] * torrent.num_pieces
+        self._order_is_stale = True
+        self._ordered_at = 0.0
 
-        # canonical list of unfulfilled requests
-        self._unfulfilled_requests: list[Request] = []
+        # a byte per piece that's 1 while we still need the piece.
+        # Built on first use, once existing pieces have been checked.
+        self._needed_pieces: Optional[bytearray] = None
+
+        # canonical unfulfilled requests, keyed by piece index and then by
+        # the request's offset within the piece. Pieces are kept in the order
+        # they should be downloaded, see `_reorder_requests`.
+        self._unfulfilled_requests: dict[int, dict[int, Request]] = {}
         self._peer_unfulfilled_requests: dict[PeerInfo, set[Request]] = defaultdict(set)
 
+        # Set, then replaced, whenever requests sent to a peer can be sent again.
+        self._requests_released = asyncio.Event()
+
         self._stats = stats
 
-    def _build_requests(self) -> list[Request]:
+    def _build_requests(self) -> dict[int, dict[int, Request]]:
         """
-        Builds the list of unfulfilled requests.
+        Builds the dictionary of unfulfilled requests.
         When we need to fill a queue with requests, we just make copies of
-        requests in our list and mark the ones we have with the peer we send
+        requests in our dictionary and mark the ones we have with the peer we send
         the request to.
 
-        :return: a list of all the requests needed to download the torrent
+        :return: all the requests needed to download the torrent, keyed by
+                 piece index and then by offset within the piece
         """
-        requests = []
+        requests = {}
 
         for piece in self.torrent.pieces:
             if not piece.complete:
-                for block in piece.blocks:
-                    requests.append(Request.from_block(block))
+                blocks = piece.blocks
+                if blocks:
+                    requests[piece.index] = {block.begin: Request.from_block(block)
+                                             for block in blocks}
 
         return requests
 
+    def _needed(self) -> bytearray:
+        """
+        :return: a byte per piece that's 1 if we still need the piece.
+        """
+        if self._needed_pieces is None:
+            self._needed_pieces = bytearray(not piece.complete
+                                            for piece in self.torrent.pieces)
+        return self._needed_pieces
+
+    def _reorder_requests(self):
+        """
+        Orders the unfulfilled requests so that pieces we've already started
+        come first, in index order, followed by the rest from the fewest
+        peers having them to the most.
+        """
+        availability = self._piece_availability
+        pieces = self.torrent.pieces
+
+        def download_order(item):
+            index, piece_requests = item
+            started = pieces[index].present or any(
+                request.peer_id for request in piece_requests.values())
+            if started:
+                return 0, 0, index
+            return 1, availability[index], index
+
+        self._unfulfilled_requests = dict(
+            sorted(self._unfulfilled_requests.items(), key=download_order))
+        self._order_is_stale = False
+        self._ordered_at = time.monotonic()
+
     def add_available_piece(self, peer: PeerInfo, index: int):
         """
         Called when a peer advertises it has a piece available.
@@ -77,7 +154,15 @@ class PieceRequester:
         """
         if not self._unfulfilled_requests:
             self._unfulfilled_requests = self._build_requests()
-        self.peer_piece_map[peer].add(index)
+            self._order_is_stale = True
+        if not 0 <= index < self.torrent.num_pieces:
+            return
+
+        pieces = self.peer_piece_map[peer]
+        if not pieces[index]:
+            pieces[index] = 1
+            self._piece_availability[index] += 1
+            self._order_is_stale = True
 
     def add_peer_bitfield(self, peer: PeerInfo, bitfield: bitstring.BitArray):
         """
@@ -90,9 +175,31 @@ class PieceRequester:
         if not self._unfulfilled_requests:
             self._unfulfilled_requests = self._build_requests()
 
-        for i, b in enumerate(bitfield):
-            if b:
-                self.add_available_piece(peer, i)
+        num_pieces = self.torrent.num_pieces
+        raw = bitfield.tobytes()
+        pieces = self.peer_piece_map[peer]
+        if raw.count(0) == len(raw):
+            return
+
+        if 1 not in pieces and _has_all_pieces(raw, num_pieces):
+            # Seeders have every piece, so skip expanding the bitfield
+            # and finding which pieces are new.
+            pieces[:] = b'\x01' * num_pieces
+            self._piece_availability = [n + 1 for n in self._piece_availability]
+            self._order_is_stale = True
+            return
+
+        # Expand the bitfield a byte at a time, dropping the spare bits at
+        # the end, then merge it with any pieces the peer already announced.
+        has = b''.join([_EXPANDED_BITS[byte] for byte in raw])
+        has = int.from_bytes(has[:num_pieces].ljust(num_pieces, b'\x00'), "big")
+        had = int.from_bytes(pieces, "big")
+        pieces[:] = (had | has).to_bytes(num_pieces, "big")
+
+        availability = self._piece_availability
+        for index in _set_indices((has & ~had).to_bytes(num_pieces, "big")):
+            availability[index] += 1
+        self._order_is_stale = True
 
     def peer_is_interesting(self, peer: PeerInfo) -> bool:
         """
@@ -107,9 +214,11 @@ class PieceRequester:
         if peer not in self.peer_piece_map:
             return False
 
-        needed = set([i for i, piece in enumerate(self.torrent.pieces)
-                      if not piece.complete])
-        peer_has = set([i for i in self.peer_piece_map[peer] if i in needed])
+        # Both bitmaps have a byte per piece that's either 0 or 1,
+        # so ANDing them as integers finds any piece in both.
+        peer_has = int.from_bytes(self.peer_piece_map[peer], "big")
+        needed = int.from_bytes(self._needed(), "big")
+        has_needed = (peer_has & needed) != 0
 
         # if not needed or not peer_has:
         #    return False
@@ -118,7 +227,7 @@ class PieceRequester:
         #    return True
         # return len(peer_has) >= self.torrent.num_pieces // 2
 
-        return len(peer_has) > 0
+        return has_needed
 
     def remove_requests_for_peer(self, peer: PeerInfo):
         """
@@ -127,9 +236,21 @@ class PieceRequester:
 
         :param peer: peer whose pending requests we should remove
         """
-        for request in self._peer_unfulfilled_requests[peer]:
+        released = self._peer_unfulfilled_requests.pop(peer, None)
+        if not released:
+            return
+
+        for request in released:
             request.peer_id = ""
-        del self._peer_unfulfilled_requests[peer]
+        self._requests_released.set()
+        self._requests_released = asyncio.Event()
+
+    async def requests_released(self):
+        """
+        Waits until requests sent to a peer are released, because that peer
+        choked us or disconnected, and can be requested from other peers.
+        """
+        await self._requests_released.wait()
 
     def peer_outstanding_requests(self, peer: PeerInfo):
         """
@@ -148,21 +269,21 @@ class PieceRequester:
         :param block: `Block` to remove from pending requests.
         :return: True if removed, False otherwise
         """
-        if not self._peer_unfulfilled_requests[peer]:
+        peer_requests = self._peer_unfulfilled_requests[peer]
+        if not peer_requests:
             return False
 
-        found = False
         request = Request.from_block(block)
+        if request not in peer_requests:
+            return False
 
-        if request in self._peer_unfulfilled_requests[peer]:
-            self._peer_unfulfilled_requests[peer].discard(request)
-            try:
-                self._unfulfilled_requests.remove(request)
-            except ValueError:
-                pass
-            finally:
-                return True
-        return False
+        peer_requests.discard(request)
+        piece_requests = self._unfulfilled_requests.get(request.index)
+        if piece_requests is not None:
+            piece_requests.pop(request.begin, None)
+            if not piece_requests:
+                del self._unfulfilled_requests[request.index]
+        return True
 
     def remove_requests_for_piece(self, piece_index: int):
         """
@@ -171,14 +292,12 @@ class PieceRequester:
 
         :param piece_index: piece index whose requests should be removed
         """
-        to_discard = []
-        for i, request in enumerate(self._unfulfilled_requests):
-            if request.index == piece_index:
-                to_discard.append(request)
-                for request_set in self._peer_unfulfilled_requests.values():
-                    request_set.discard(request)
-        for r in to_discard:
-            self._unfulfilled_requests.remove(r)
+        piece_requests = self._unfulfilled_requests.pop(piece_index, None)
+        if not piece_requests:
+            return
+
+        for request_set in self._peer_unfulfilled_requests.values():
+            request_set.difference_update(piece_requests.values())
 
     def remove_peer(self, peer: PeerInfo):
         """
@@ -187,60 +306,96 @@ class PieceRequester:
 
         :param peer: peer to remove
         """
-        if peer in self.peer_piece_map:
-            del self.peer_piece_map[peer]
+        pieces = self.peer_piece_map.pop(peer, None)
+        if pieces is not None:
+            availability = self._piece_availability
+            for index in _set_indices(pieces):
+                availability[index] -= 1
+            self._order_is_stale = True
 
         self.remove_requests_for_peer(peer)
 
-    def fill_peer_request_queue(self, peer: PeerInfo, msg_queue: asyncio.Queue) -> bool:
+    def fill_peer_request_queue(self, peer: PeerInfo, msg_queue: deque,
+                                max_queued: int) -> bool:
         """
         Fills the given queue with up to 10 new requests for the peer, returning
         True if more requests were added or False otherwise.
+        Requests are only made for the room left in the queue, so none are
+        marked requested and then dropped.
 
         :param peer: The peer asking for a top up
         :param msg_queue: the message queue to place the requests into
+        :param max_queued: the most messages the queue should hold
         :return: True if more requests were added or the peer has any outstanding.
         """
-        added_more = False
-        num_needed = 10 - len(self._peer_unfulfilled_requests[peer])
+        num_needed = min(self._max_outstanding_requests
+                         - len(self._peer_unfulfilled_requests[peer]),
+                         max_queued - len(msg_queue))
 
-        for _ in range(num_needed):
-            request = self.next_request_for_peer(peer)
-            if not request:  # no more requests for this peer
-                break
-            asyncio.create_task(msg_queue.put(request))
-            added_more = True
-        return added_more
+        requests = self.next_requests_for_peer(peer, num_needed)
+        for request in requests:
+            msg_queue.append(request)
+        return len(requests) > 0
 
     def next_request_for_peer(self, peer: PeerInfo) -> Optional[Request]:
         """
         Finds the next request for the peer.
 
-        Searches over each unfulfilled request (currently in order), skipping
-        those that have been requested from other peers or the peer doesn't have
-        available until finding a request. The peer is marked as being the requester
-        and a copy of the request is returned.
-
         :param peer: The peer to retrieve the next request for.
         :return: The next `Request` to send, or None if not available.
         """
-        if peer not in self.peer_piece_map:
-            return
-        if len(self.peer_piece_map[peer]) == 0:
-            return
+        requests = self.next_requests_for_peer(peer, 1)
+        if requests:
+            return requests[0]
 
-        found_request = None
-        for request in self._unfulfilled_requests:
-            if request.peer_id:
-                continue
-            if request.index not in self.peer_piece_map[peer]:
-                continue
-            request.peer_id = peer.peer_id
-            self._peer_unfulfilled_requests[peer].add(request)
-            found_request = request
-            break
+    def next_requests_for_peer(self, peer: PeerInfo, num: int) -> list[Request]:
+        """
+        Finds up to `num` of the next requests for the peer.
 
-        return found_request
+        Searches over each unfulfilled request (rarest pieces first) once, skipping
+        those that have been requested from other peers or the peer doesn't have
+        available. Pieces the peer doesn't have are skipped all at once.
+        The peer is marked as being the requester of each request found.
+
+        :param peer: The peer to retrieve the next requests for.
+        :param num: The maximum number of requests to retrieve.
+        :return: A list of up to `num` `Request`s to send.
+        """
+        if num <= 0 or peer not in self.peer_piece_map:
+            return []
+
+        peer_pieces = self.peer_piece_map[peer]
+        if 1 not in peer_pieces:
+            return []
+
+        # Piece availability changes with every Have, so only reorder
+        # periodically rather than on every call.
+        if (self._order_is_stale and
+                time.monotonic() - self._ordered_at >= self._reorder_interval):
+            self._reorder_requests()
+
+        found_requests = []
+        peer_requests = self._peer_unfulfilled_requests[peer]
+        pieces = self.torrent.pieces
+        for index, piece_requests in self._unfulfilled_requests.items():
+            if not peer_pieces[index]:
+                continue
+            started = pieces[index].present > 0
+            for request in piece_requests.values():
+                if request.peer_id:
+                    started = True
+                    continue
+                if not started:
+                    # Starting a new piece moves it ahead of the unstarted ones.
+                    started = True
+                    self._order_is_stale = True
+                request.peer_id = peer.peer_id
+                peer_requests.add(request)
+                found_requests.append(request)
+                if len(found_requests) == num:
+                    return found_requests
+
+        return found_requests
 
     def peer_received_block(self, block: Block, peer: PeerInfo) -> Optional[Piece]:
         """
@@ -258,20 +413,19 @@ class PieceRequester:
         block_size = len(block.data)
 
         if block.index >= len(self.torrent.pieces):
-            logger.debug("Disregarding. Piece %s does not exist." % block.index)
+            logger.debug("Disregarding. Piece %s does not exist.", block.index)
             self._stats.torrent_bytes_wasted += block_size
             return
 
         piece = self.torrent.pieces[block.index]
         if piece.complete:
-            logger.debug("Disregarding. I already have %s" % block)
+            logger.debug("Disregarding. I already have %s", block)
             self._stats.torrent_bytes_wasted += block_size
             return
 
         # Remove the pending requests for this block if there are any
-        request = Request.from_block(block)
         if not self.remove_requests_for_block(peer, block):
-            logger.debug("Disregarding. I did not request %s" % block)
+            logger.debug("Disregarding. I did not request %s", block)
             self._stats.torrent_bytes_wasted += block_size
             return
 
@@ -279,7 +433,7 @@ class PieceRequester:
             piece.add_block(block)
         except NonSequentialBlockError:
             # TODO: Handle non-sequential blocks?
-            logger.error("Block begin index is non-sequential for: %s" % block)
+            logger.error("Block begin index is non-sequential for: %s", block)
             self._stats.torrent_bytes_wasted += block_size
             return
 
@@ -305,13 +459,16 @@ class PieceRequester:
             return
 
         h = piece.hash()
-        if h != self.torrent.piece_hashes[piece.index]:
+        expected = self.torrent.piece_hashes[piece_index]
+        if h != expected:
             logger.error(
-                "Hash for received piece %s doesn't match. Received: %s\tExpected: %s" %
-                (piece.index, h, self.torrent.piece_hashes[piece.index]))
+                "Hash for received piece %s doesn't match. Received: %s\tExpected: %s",
+                piece_index, h, expected)
             piece.reset()
             self._stats.torrent_bytes_wasted += piece.length
         else:
-            logger.info("Completed piece received: %s" % piece)
+            logger.info("Completed piece received: %s", piece)
+            if self._needed_pieces is not None:
+                self._needed_pieces[piece_index] = 0
             self.remove_requests_for_piece(piece.index)
             return piece
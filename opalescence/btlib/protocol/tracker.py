@@ -148,7 +148,7 @@ class TrackerConnection:
             event = EVENT_COMPLETED
 
         url = self.announce_urls.popleft()
-        logger.info("Making %s announce to %s" % (event, url))
+        logger.info("Making %s announce to %s", event, url)
         params = TrackerParameters(self.torrent.info_hash,
                                    self.client_info.peer_id_bytes,
                                    self.client_info.port,
@@ -163,7 +163,7 @@ class TrackerConnection:
             if decoded_data is None:
                 raise TrackerConnectionError
         except Exception as e:
-            logger.error("%s received in announce." % type(e).__name__)
+            logger.error("%s received in announce.", type(e).__name__)
             raise TrackerConnectionError from e
 
         if event != EVENT_COMPLETED and event != EVENT_STOPPED:
@@ -301,7 +301,7 @@ class TrackerTask(TrackerConnection):
             # when the tracker task is done because torrent completion
             # will have happened and (should have) triggered cancellation
             # of this task.
-            logger.error("%s received in TrackerTask" % type(exc).__name__)
+            logger.error("%s received in TrackerTask", type(exc).__name__)
             announce_task.cancel()
             receive_task.cancel()
             self.task.cancel()
@@ -7,6 +7,7 @@ Main logic for facilitating the download of a torrent.
 import asyncio
 import functools
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
 from typing import Optional
@@ -93,8 +94,8 @@ class Torrent:
     def download(self):
         logger.info("Checking existing pieces...")
         self.torrent.check_existing_pieces()
-        logger.info("We have %s / %s bytes" % (self.torrent.present,
-                                               self.torrent.total_size))
+        logger.info("We have %s / %s bytes", self.torrent.present,
+                    self.torrent.total_size)
 
         self.download_started = asyncio.get_event_loop().time()
         self.started_with = self.torrent.present
@@ -134,7 +135,7 @@ class Torrent:
                 # monitor tasks
                 for name, task in tasks.items():
                     if task.cancelled():
-                        logger.info("%s: %s _task cancelled." % (self.torrent, name))
+                        logger.info("%s: %s _task cancelled.", self.torrent, name)
                         raise TorrentError
 
                 await asyncio.sleep(.5)
@@ -146,12 +147,12 @@ class Torrent:
         except Exception as e:
             self.status = DownloadStatus.Errored
             if not isinstance(e, asyncio.CancelledError):
-                logger.error("%s exception received in Torrent.download." % type(
-                    e).__name__)
+                logger.error("%s exception received in Torrent.download.",
+                             type(e).__name__)
         finally:
             if self.status != DownloadStatus.Errored:
                 self.status = DownloadStatus.Stopped
-            logger.debug(f"Ending download loop and cleaning up.")
+            logger.debug("Ending download loop and cleaning up.")
             self.tracker.stop()
             self.peer_pool.stop()
             self.file_writer.stop()
@@ -169,7 +170,13 @@ class FileWriterTask(FileWriter):
     def __init__(self, torrent: MetaInfoFile, piece_queue: asyncio.Queue):
         super().__init__(torrent.files, torrent.piece_length)
         self._queue: asyncio.Queue = piece_queue
-        self._lock = asyncio.Lock()
+        # Pieces are written one at a time, in the order they're received,
+        # on a thread of their own so nothing else in the default
+        # executor can hold them up.
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix="piece-writer")
+        # The event loop only keeps weak references to tasks.
+        self._writes: set[asyncio.Task] = set()
         self.task: asyncio.Task = asyncio.create_task(self._write_pieces())
 
     def stop(self):
@@ -188,39 +195,64 @@ class FileWriterTask(FileWriter):
         try:
             while True:
                 piece = await self._queue.get()
-                asyncio.create_task(self._await_write(piece))
+                self._schedule_write(piece)
                 self._queue.task_done()
+        except asyncio.CancelledError:
+            # Pieces that were verified before we were stopped still need
+            # to reach the disk.
+            while not self._queue.empty():
+                piece = self._queue.get_nowait()
+                self._schedule_write(piece)
+                self._queue.task_done()
+            raise
         except Exception as exc:
-            logger.error("Encountered %s exception writing %s" %
-                         (type(exc).__name__, piece))
+            logger.error("Encountered %s exception writing %s",
+                         type(exc).__name__, piece)
             if not isinstance(exc, FileWriterError):
                 raise FileWriterError from exc
             raise
         finally:
-            self.close_files()
+            # The files are closed on the writer's thread once every write
+            # that's been scheduled has finished, so they can't be closed
+            # under a write even if we're cancelled again while waiting.
+            # We wait off the event loop so peers aren't stalled.
+            self._executor.submit(self.close_files)
+            loop = asyncio.get_running_loop()
+            await asyncio.shield(loop.run_in_executor(None, functools.partial(
+                self._executor.shutdown, wait=True)))
 
-    async def _await_write(self, piece):
+    def _schedule_write(self, piece):
         """
-        Schedules and awaits for the task in the executor responsible
-        for writing the piece. Marks the piece complete on success.
+        Submits the piece to the executor to be written right away, so it's
+        written even if we're stopped before the write is awaited.
 
         :param piece: piece to write
         """
         self.open_files()
-        if not self._fps:
+        if not self._fds:
             raise FileWriterError("Unable to open files.")
 
-        await self._lock.acquire()
+        loop = asyncio.get_running_loop()
+        write = loop.run_in_executor(self._executor, functools.partial(
+            self._write_piece_data, piece))
+        task = asyncio.create_task(self._await_write(piece, write))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    @staticmethod
+    async def _await_write(piece, write: asyncio.Future):
+        """
+        Awaits the write of the piece scheduled in the executor.
+        Marks the piece complete on success.
 
+        :param piece: piece being written
+        :param write: future for the write running in the executor
+        """
         try:
-            loop = asyncio.get_running_loop()
-            await loop.run_in_executor(None, functools.partial(
-                self._write_piece_data, piece))
+            await write
             piece.mark_written()  # purge from memory
         except Exception as e:
             logger.error(e)
             if not isinstance(e, FileWriterError):
                 raise FileWriterError from e
             raise
-        finally:
-            self._lock.release()
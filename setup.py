@@ -25,6 +25,7 @@ setup(
     url="https://github.com/killerbat00/opalescence",
     packages=["opalescence"],
     install_requires=requirements,
+    extras_require={"uvloop": ["uvloop>=0.15"]},
     license="MIT license",
     zip_safe=False,
     keywords="torrent",
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests finding and writing the files a torrent's pieces belong to.
+"""
+import asyncio
+import os
+import stat
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase, mock
+
+from opalescence.btlib.protocol.fileio import FileItem, FileWriter
+from opalescence.btlib.protocol.messages import Block, Piece
+from opalescence.btlib.torrent import FileWriterTask
+from tests.utils import async_run
+
+
+def make_piece(index: int, data: bytes) -> Piece:
+    """
+    :return: a complete piece holding the given data in a single block.
+    """
+    piece = Piece(index, len(data), len(data))
+    block = Block(index, 0, len(data))
+    block.data = data
+    piece.add_block(block)
+    return piece
+
+
+def make_files(sizes, root=Path(".")) -> dict[int, FileItem]:
+    """
+    :return: `FileItem`s with the given sizes laid out one after another.
+    """
+    files = {}
+    offset = 0
+    for i, size in enumerate(sizes):
+        files[i] = FileItem(root / f"file{i}", size, offset, False)
+        offset += size
+    return files
+
+
+class TestFileForOffset(TestCase):
+    """
+    Tests finding the file a contiguous offset falls in.
+    """
+
+    def assert_offsets(self, sizes, expected):
+        files = make_files(sizes)
+        file_offsets = [file.offset for file in files.values()]
+        for offset, located in expected.items():
+            with self.subTest(msg=f"Offset {offset} in files of sizes {sizes}"):
+                self.assertEqual(FileItem.file_for_offset(files, offset), located)
+                self.assertEqual(FileItem.file_for_offset(files, offset, file_offsets),
+                                 located)
+
+    def test_single_file(self):
+        """
+        Test offsets within, and past the end of, a single file.
+        """
+        self.assert_offsets([10], {0: (0, 0), 9: (0, 9), 10: None, 11: None})
+
+    def test_file_boundaries(self):
+        """
+        Test that an offset at a file boundary is the start of the next file.
+        """
+        self.assert_offsets([5, 3, 4], {
+            4: (0, 4), 5: (1, 0),
+            7: (1, 2), 8: (2, 0),
+            11: (2, 3), 12: None,
+        })
+
+    def test_zero_length_files(self):
+        """
+        Test that empty files are skipped, wherever they are.
+        """
+        with self.subTest(msg="Between files"):
+            self.assert_offsets([5, 0, 3, 0, 0, 4], {
+                4: (0, 4), 5: (2, 0), 7: (2, 2), 8: (5, 0), 11: (5, 3), 12: None,
+            })
+        with self.subTest(msg="First files"):
+            self.assert_offsets([0, 0, 4], {0: (2, 0), 3: (2, 3), 4: None})
+        with self.subTest(msg="Last files"):
+            self.assert_offsets([4, 0, 0], {0: (0, 0), 3: (0, 3), 4: None})
+        with self.subTest(msg="Only empty files"):
+            self.assert_offsets([0, 0], {0: None, 1: None})
+
+
+class TestFileWriter(TestCase):
+    """
+    Tests writing pieces that span several files.
+    """
+
+    def test_write_across_files(self):
+        """
+        Test that a piece spanning files, including empty ones, is split
+        between them, and that the files aren't created executable.
+        """
+        sizes = [3, 0, 5, 2]
+        data = bytes(range(1, sum(sizes) + 1))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            files = make_files(sizes, Path(tmp))
+            writer = FileWriter(files, len(data))
+            piece = Piece(0, len(data), 4)
+            for begin in range(0, len(data), 4):
+                block = Block(0, begin, 4)
+                block.data = data[begin:begin + 4]
+                piece.add_block(block)
+
+            writer.open_files()
+            try:
+                writer._write_piece_data(piece)
+            finally:
+                writer.close_files()
+
+            offset = 0
+            for file in files.values():
+                with self.subTest(msg=f"Contents of {file.path.name}"):
+                    self.assertEqual(file.path.read_bytes(),
+                                     data[offset:offset + file.size])
+                if os.name == "posix":
+                    with self.subTest(msg=f"Mode of {file.path.name}"):
+                        mode = stat.S_IMODE(os.stat(file.path).st_mode)
+                        self.assertFalse(mode & 0o111)
+                offset += file.size
+
+
+class TestFileWriterTask(TestCase):
+    """
+    Tests writing completed pieces as they're queued.
+    """
+
+    def test_stop_with_pending_pieces(self):
+        """
+        Test that pieces queued before the writer is stopped are still
+        written to disk, and the files are only closed once they are.
+        """
+        piece_length, num_pieces = 4, 6
+        data = bytes(range(1, piece_length * num_pieces + 1))
+
+        async def run(tmp, cancel_again):
+            files = make_files([2 * piece_length, 4 * piece_length], Path(tmp))
+            torrent = mock.MagicMock(files=files, piece_length=piece_length)
+            piece_queue = asyncio.Queue()
+            writer = FileWriterTask(torrent, piece_queue)
+            # Slow writes down so they're still going when we're stopped.
+            write_piece_data = writer._write_piece_data
+            writer._write_piece_data = lambda piece: (time.sleep(.01),
+                                                      write_piece_data(piece))
+            await asyncio.sleep(0)
+            for i in range(num_pieces):
+                begin = i * piece_length
+                piece_queue.put_nowait(make_piece(i, data[begin:begin + piece_length]))
+            writer.stop()
+            if cancel_again:
+                # Cancelled again while waiting for the writes to finish.
+                for _ in range(3):
+                    await asyncio.sleep(0)
+                writer.task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await writer.task
+            return writer, files
+
+        for cancel_again in (False, True):
+            with self.subTest(msg=f"Cancelled again: {cancel_again}"), \
+                    tempfile.TemporaryDirectory() as tmp:
+                writer, files = async_run(run(tmp, cancel_again))
+                writer._executor.shutdown(wait=True)
+                self.assertEqual(writer._fds, {})
+                written = b"".join(file.path.read_bytes() for file in files.values())
+                self.assertEqual(written, data)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests the `Piece` representation of a piece of the torrent.
+"""
+import hashlib
+import itertools
+from unittest import TestCase
+
+from opalescence.btlib.protocol.messages import Block, Piece
+
+
+def make_block(index: int, begin: int, data: bytes) -> Block:
+    """
+    :return: a `Block` carrying the given data.
+    """
+    block = Block(index, begin, len(data))
+    block.data = data
+    return block
+
+
+class TestPiece(TestCase):
+    """
+    Tests a piece's data is hashed correctly as its blocks arrive.
+    """
+    block_size = 4
+    # The last block is shorter than the rest.
+    data = bytes(range(14))
+
+    def add_blocks(self, piece: Piece, order):
+        """
+        Adds the piece's blocks in the given order of block indices.
+        """
+        for block_index in order:
+            begin = block_index * self.block_size
+            piece.add_block(make_block(piece.index, begin,
+                                       self.data[begin:begin + self.block_size]))
+
+    def test_hash_in_order(self):
+        """
+        Test that a piece received in order hashes to the hash of its data.
+        """
+        piece = Piece(0, len(self.data), self.block_size)
+        self.add_blocks(piece, range(4))
+        self.assertTrue(piece.complete)
+        self.assertEqual(piece.hash(), hashlib.sha1(self.data).digest())
+
+    def test_hash_out_of_order(self):
+        """
+        Test that the hash doesn't depend on the order blocks arrive in.
+        """
+        expected = hashlib.sha1(self.data).digest()
+        for order in itertools.permutations(range(4)):
+            with self.subTest(msg=f"Blocks received in order {order}"):
+                piece = Piece(0, len(self.data), self.block_size)
+                self.add_blocks(piece, order)
+                self.assertEqual(piece.hash(), expected)
+
+    def test_hash_incomplete(self):
+        """
+        Test that an incomplete piece has no hash.
+        """
+        piece = Piece(0, len(self.data), self.block_size)
+        self.add_blocks(piece, (0, 1, 3))
+        self.assertIsNone(piece.hash())
+
+    def test_hash_after_reset(self):
+        """
+        Test that data received before a reset doesn't affect the hash.
+        """
+        expected = hashlib.sha1(self.data).digest()
+
+        with self.subTest(msg="Reset partway through"):
+            piece = Piece(0, len(self.data), self.block_size)
+            self.add_blocks(piece, (0, 2, 1))
+            piece.reset()
+            self.assertEqual(piece.present, 0)
+            self.add_blocks(piece, (3, 2, 1, 0))
+            self.assertEqual(piece.hash(), expected)
+
+        with self.subTest(msg="Reset after bad data"):
+            piece = Piece(0, len(self.data), self.block_size)
+            piece.add_block(make_block(0, 0, b"\xff" * self.block_size))
+            self.add_blocks(piece, (1, 2, 3))
+            self.assertNotEqual(piece.hash(), expected)
+            piece.reset()
+            self.add_blocks(piece, (1, 0, 3, 2))
+            self.assertEqual(piece.hash(), expected)
+
+    def test_hash_after_written(self):
+        """
+        Test that a piece's data is no longer hashed once it's been written.
+        """
+        piece = Piece(0, len(self.data), self.block_size)
+        self.add_blocks(piece, range(4))
+        piece.mark_written()
+        self.assertIsNone(piece.hash())
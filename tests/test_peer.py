@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests the framing of messages received from a peer by `PeerStream`.
+"""
+import asyncio
+import struct
+from unittest import TestCase, mock
+
+from opalescence.btlib.protocol.errors import PeerError
+from opalescence.btlib.protocol.messages import Handshake
+from opalescence.btlib.protocol.peer import (PeerConnection, PeerConnectionStats,
+                                             PeerStream, _frame_size_limit)
+from opalescence.btlib.protocol.peer_info import PeerInfo
+from tests.utils import async_run
+
+
+def frame(payload: bytes) -> bytes:
+    """
+    :return: the payload prefixed with its length, as sent by a peer.
+    """
+    return struct.pack(">I", len(payload)) + payload
+
+
+class SmallPeerStream(PeerStream):
+    """
+    `PeerStream` with a tiny receive buffer so it fills up quickly.
+    """
+    buffer_size = 16
+
+
+def make_stream(stream_type=PeerStream) -> PeerStream:
+    """
+    Creates a stream connected to a mock transport. Must be called with
+    the event loop running.
+    """
+    stream = stream_type()
+    stream.connection_made(mock.MagicMock())
+    return stream
+
+
+def receive(stream: PeerStream, data: bytes) -> bytes:
+    """
+    Feeds data to the stream the way the event loop does, filling at most
+    one buffer returned by `get_buffer`.
+
+    :return: whatever didn't fit in the buffer.
+    """
+    buf = stream.get_buffer(-1)
+    n = min(len(buf), len(data))
+    buf[:n] = data[:n]
+    stream.buffer_updated(n)
+    return data[n:]
+
+
+class TestPeerStream(TestCase):
+    """
+    Tests reading length-prefixed messages out of the receive buffer.
+    """
+
+    def test_readframe(self):
+        """
+        Test that complete frames are read without waiting.
+        """
+
+        async def run():
+            stream = make_stream()
+            receive(stream, frame(b"\x00") + frame(b"\x07abc"))
+            with self.subTest(msg="First frame"):
+                self.assertEqual(bytes(await stream.readframe()), b"\x00")
+            with self.subTest(msg="Second frame"):
+                self.assertEqual(bytes(await stream.readframe()), b"\x07abc")
+
+        async_run(run())
+
+    def test_keep_alive(self):
+        """
+        Test that a zero-length frame is read as an empty message.
+        """
+
+        async def run():
+            stream = make_stream()
+            receive(stream, frame(b""))
+            self.assertEqual(bytes(await stream.readframe()), b"")
+
+        async_run(run())
+
+    def test_split_frames(self):
+        """
+        Test that frames split across several `buffer_updated` calls are
+        only returned once all of their data has arrived.
+        """
+        data = frame(b"\x07" + bytes(range(10))) + frame(b"\x01")
+
+        for split in (1, 2, 3, 4, 5, 14, 15, 16):
+            with self.subTest(msg=f"Split at {split}"):
+                async def run():
+                    stream = make_stream()
+                    receive(stream, data[:split])
+                    reader = asyncio.ensure_future(stream.readframe())
+                    await asyncio.sleep(0)
+                    self.assertEqual(reader.done(), split >= 15)
+                    # The frame is a view of the buffer, so it has to be read
+                    # before any more data is received.
+                    if reader.done():
+                        first = bytes(reader.result())
+                        receive(stream, data[split:])
+                    else:
+                        receive(stream, data[split:])
+                        first = bytes(await reader)
+                    self.assertEqual(first, b"\x07" + bytes(range(10)))
+                    self.assertEqual(bytes(await stream.readframe()), b"\x01")
+
+                async_run(run())
+
+    def test_one_byte_at_a_time(self):
+        """
+        Test that frames are reassembled when every byte arrives on its own.
+        """
+        payloads = [b"\x04" + bytes(4), b"", b"\x07" + bytes(range(9))]
+        data = b"".join(frame(payload) for payload in payloads)
+
+        async def run():
+            stream = make_stream()
+            received = []
+            pending = data
+            while len(received) < len(payloads):
+                reader = asyncio.ensure_future(stream.readframe())
+                await asyncio.sleep(0)
+                while not reader.done():
+                    receive(stream, pending[:1])
+                    pending = pending[1:]
+                    await asyncio.sleep(0)
+                received.append(bytes(reader.result()))
+            return received
+
+        self.assertEqual(async_run(run()), payloads)
+
+    def test_compaction(self):
+        """
+        Test that unread data is moved to the front of the buffer once the
+        end of the buffer is reached, and that reading resumes afterwards.
+        """
+
+        async def run():
+            stream = make_stream(SmallPeerStream)
+            # 6 + 6 bytes of complete frames, then the start of a 7 byte frame.
+            data = frame(b"\x01\x02") + frame(b"\x03\x04") + frame(b"\x05\x06\x07")
+            rest = receive(stream, data)
+            self.assertEqual(rest, data[16:])
+            with self.subTest(msg="Reading paused when the buffer is full"):
+                stream.transport.pause_reading.assert_called_once()
+
+            self.assertEqual(bytes(await stream.readframe()), b"\x01\x02")
+            with self.subTest(msg="Reading resumed once data is read"):
+                stream.transport.resume_reading.assert_called_once()
+            self.assertEqual(bytes(await stream.readframe()), b"\x03\x04")
+
+            # The 4 unread bytes are moved to the front to make room.
+            buf = stream.get_buffer(-1)
+            with self.subTest(msg="Unread data moved to the front"):
+                self.assertEqual(len(buf), SmallPeerStream.buffer_size - 4)
+                self.assertEqual(bytes(stream._buffer[:4]), data[12:16])
+
+            receive(stream, rest)
+            self.assertEqual(bytes(await stream.readframe()), b"\x05\x06\x07")
+
+        async_run(run())
+
+    def test_overlapping_compaction(self):
+        """
+        Test that unread data is moved intact when it overlaps the front of
+        the buffer it's moved to.
+        """
+
+        async def run():
+            stream = make_stream(SmallPeerStream)
+            # A 6 byte frame, then a 12 byte frame that doesn't fit after it.
+            data = frame(b"\x01\x02") + frame(bytes(range(3, 11)) + b"\x0b\x0c")
+            rest = receive(stream, data)
+            self.assertEqual(bytes(await stream.readframe()), b"\x01\x02")
+
+            # 10 unread bytes are moved back 6 bytes.
+            buf = stream.get_buffer(-1)
+            with self.subTest(msg="Unread data moved to the front"):
+                self.assertEqual(len(buf), SmallPeerStream.buffer_size - 10)
+                self.assertEqual(bytes(stream._buffer[:10]), data[6:16])
+
+            receive(stream, rest)
+            self.assertEqual(bytes(await stream.readframe()), data[10:])
+
+        async_run(run())
+
+    def test_grow(self):
+        """
+        Test that frames larger than the buffer are still read whole.
+        """
+        payload = b"\x07" + bytes(range(40))
+
+        async def run():
+            stream = make_stream(SmallPeerStream)
+            pending = frame(payload)
+            reader = asyncio.ensure_future(stream.readframe())
+            while pending:
+                pending = receive(stream, pending)
+                await asyncio.sleep(0)
+            self.assertEqual(bytes(await reader), payload)
+
+        async_run(run())
+
+    def test_eof(self):
+        """
+        Test that the end of the connection between frames reads as None,
+        while the end of the connection partway through a frame is an error.
+        """
+
+        async def run_between():
+            stream = make_stream()
+            receive(stream, frame(b"\x01"))
+            stream.eof_received()
+            self.assertEqual(bytes(await stream.readframe()), b"\x01")
+            self.assertIsNone(await stream.readframe())
+
+        async def run_partial():
+            stream = make_stream()
+            receive(stream, frame(b"\x07abc")[:6])
+            stream.eof_received()
+            await stream.readframe()
+
+        with self.subTest(msg="Between frames"):
+            async_run(run_between())
+        with self.subTest(msg="Partway through a frame"):
+            with self.assertRaises(asyncio.IncompleteReadError):
+                async_run(run_partial())
+
+    def test_oversized_frame(self):
+        """
+        Test that a frame larger than the limit is rejected from its length
+        prefix alone, without growing the buffer to fit it.
+        """
+
+        async def run(stream_type, msg_len):
+            stream = make_stream(stream_type)
+            receive(stream, struct.pack(">I", msg_len) + b"\x07")
+            try:
+                await stream.readframe()
+            finally:
+                self.assertEqual(len(stream._buffer), stream_type.buffer_size)
+
+        # One byte more than the largest Block, 200 MiB, and the largest prefix.
+        for msg_len in (9 + 2 ** 14 + 1, 200 * 2 ** 20, 2 ** 32 - 1):
+            with self.subTest(msg=f"Frame of {msg_len} bytes"):
+                with self.assertRaises(PeerError):
+                    async_run(run(SmallPeerStream, msg_len))
+
+    def test_largest_frame(self):
+        """
+        Test that the largest legal Block and Bitfield frames are read.
+        """
+
+        async def run(max_frame_size, payload):
+            stream = SmallPeerStream(max_frame_size)
+            stream.connection_made(mock.MagicMock())
+            pending = frame(payload)
+            reader = asyncio.ensure_future(stream.readframe())
+            # Stop feeding once the reader gives up, since nothing will make
+            # room in the buffer after that.
+            while pending and not reader.done():
+                pending = receive(stream, pending)
+                await asyncio.sleep(0)
+            return bytes(await reader)
+
+        with self.subTest(msg="Block"):
+            payload = b"\x07" + bytes(8 + 2 ** 14)
+            self.assertEqual(async_run(run(_frame_size_limit(8), payload)), payload)
+        with self.subTest(msg="Bitfield"):
+            num_pieces = 2 ** 18 + 1
+            payload = b"\x05" + bytes((num_pieces + 7) // 8)
+            self.assertEqual(async_run(run(_frame_size_limit(num_pieces), payload)),
+                             payload)
+            with self.assertRaises(PeerError):
+                async_run(run(_frame_size_limit(num_pieces - 8), payload))
+
+    def test_drain_after_close(self):
+        """
+        Test that draining a closed connection fails instead of waiting for
+        writing to resume.
+        """
+
+        async def run():
+            stream = make_stream()
+            stream.pause_writing()
+            waiter = asyncio.ensure_future(stream.drain())
+            await asyncio.sleep(0)
+            stream.connection_lost(None)
+            with self.subTest(msg="Waiting drain"):
+                with self.assertRaises(ConnectionResetError):
+                    await asyncio.wait_for(waiter, 1)
+            with self.subTest(msg="Drain after close"):
+                with self.assertRaises(ConnectionResetError):
+                    await asyncio.wait_for(stream.drain(), 1)
+
+        async_run(run())
+
+
+class TestPeerConnection(TestCase):
+    """
+    Tests moving between the peers a `PeerConnection` is given.
+    """
+    info_hash = bytes(range(20))
+
+    def test_next_peer_after_close(self):
+        """
+        Test that the connection moves on to the next queued peer after
+        the remote end closes the connection.
+        """
+
+        async def run():
+            connected = []
+            handshake = Handshake(self.info_hash, b"-RM0000-" + bytes(12)).encode()
+
+            async def serve(reader, writer):
+                connected.append(writer.get_extra_info("sockname")[1])
+                await reader.readexactly(Handshake.msg_len)
+                writer.write(handshake)
+                await writer.drain()
+                writer.close()
+
+            servers = [await asyncio.start_server(serve, "127.0.0.1", 0)
+                       for _ in range(2)]
+            ports = [server.sockets[0].getsockname()[1] for server in servers]
+
+            peer_queue = asyncio.Queue()
+            for port in ports:
+                peer_queue.put_nowait(PeerInfo("127.0.0.1", port))
+            requester = mock.MagicMock()
+            requester.torrent.complete = False
+            torrent = mock.MagicMock(info_hash=self.info_hash, num_pieces=1)
+            conn = PeerConnection(PeerInfo("127.0.0.1", 6881), torrent, requester,
+                                  peer_queue, asyncio.Queue(), PeerConnectionStats(),
+                                  handshake)
+            conn.start()
+            try:
+                for _ in range(100):
+                    if len(connected) == 2 and conn.peer is None:
+                        break
+                    await asyncio.sleep(.01)
+                running = not conn.task.done()
+            finally:
+                conn.stop_forever()
+                await asyncio.gather(conn.task, return_exceptions=True)
+                for server in servers:
+                    server.close()
+                    await server.wait_closed()
+
+            self.assertEqual(connected, ports)
+            with self.subTest(msg="Still running after both peers closed"):
+                self.assertTrue(running)
+
+        async_run(run())
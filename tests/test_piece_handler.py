@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests the order pieces are requested from peers in by `PieceRequester`.
+"""
+from collections import deque
+from types import SimpleNamespace
+from unittest import TestCase
+
+import bitstring
+
+from opalescence.btlib.protocol.messages import Piece
+from opalescence.btlib.protocol.peer import PeerConnectionStats
+from opalescence.btlib.protocol.peer_info import PeerInfo
+from opalescence.btlib.protocol.piece_handler import PieceRequester
+
+BLOCK_SIZE = PieceRequester._block_size
+
+
+class TestPieceRequester(TestCase):
+    """
+    Tests rarest-first piece ordering.
+    """
+    num_pieces = 4
+
+    def setUp(self):
+        # Every piece is two blocks long.
+        pieces = [Piece(i, 2 * BLOCK_SIZE, BLOCK_SIZE) for i in range(self.num_pieces)]
+        torrent = SimpleNamespace(num_pieces=self.num_pieces, pieces=pieces)
+        self.requester = PieceRequester(torrent, PeerConnectionStats())
+        # Reorder on every request so availability changes are seen immediately.
+        self.requester._reorder_interval = 0
+
+        self.a = PeerInfo("127.0.0.1", 6881)
+        self.b = PeerInfo("127.0.0.2", 6881)
+        self.c = PeerInfo("127.0.0.3", 6881)
+        # piece: 0  1  2  3
+        # a:     x  x  x  x
+        # b:        x  x
+        # c:           x
+        self.add_pieces(self.a, range(4))
+        self.add_pieces(self.b, (1, 2))
+        self.add_pieces(self.c, (2,))
+
+    def add_pieces(self, peer: PeerInfo, indices):
+        for index in indices:
+            self.requester.add_available_piece(peer, index)
+
+    def next_pieces(self, peer: PeerInfo, num: int) -> list[tuple[int, int]]:
+        """
+        :return: (piece index, offset) of the next `num` requests for the peer.
+        """
+        return [(request.index, request.begin // BLOCK_SIZE)
+                for request in self.requester.next_requests_for_peer(peer, num)]
+
+    def test_rarest_first(self):
+        """
+        Test that the pieces fewest peers have are requested first,
+        in index order when they're equally rare.
+        """
+        self.assertEqual(self.next_pieces(self.a, 8),
+                         [(0, 0), (0, 1), (3, 0), (3, 1),
+                          (1, 0), (1, 1), (2, 0), (2, 1)])
+
+    def test_started_pieces_first(self):
+        """
+        Test that pieces we've started downloading are finished before
+        rarer pieces are started.
+        """
+        with self.subTest(msg="Rarest piece the peer has"):
+            self.assertEqual(self.next_pieces(self.b, 1), [(1, 0)])
+        with self.subTest(msg="Started piece before rarer pieces"):
+            self.assertEqual(self.next_pieces(self.a, 3), [(1, 1), (0, 0), (0, 1)])
+
+    def test_peer_only_gets_pieces_it_has(self):
+        """
+        Test that pieces the peer doesn't have are skipped.
+        """
+        self.assertEqual(self.next_pieces(self.c, 4), [(2, 0), (2, 1)])
+
+    def test_bitfield_availability(self):
+        """
+        Test that pieces announced in a bitfield count towards availability,
+        without counting pieces the peer already announced twice.
+        """
+        d = PeerInfo("127.0.0.4", 6881)
+        self.add_pieces(d, (0,))
+        # The bitfield repeats piece 0, which must only be counted once.
+        self.requester.add_peer_bitfield(d, bitstring.BitArray("0b10010000"))
+        self.add_pieces(self.c, (0,))
+        self.assertEqual(self.next_pieces(self.a, 8),
+                         [(1, 0), (1, 1), (3, 0), (3, 1),
+                          (0, 0), (0, 1), (2, 0), (2, 1)])
+
+    def test_remove_peer(self):
+        """
+        Test that a removed peer's pieces no longer count towards availability.
+        """
+        self.requester.remove_peer(self.b)
+        self.add_pieces(self.c, (0, 3))
+        # piece: 0  1  2  3
+        # a:     x  x  x  x
+        # c:     x     x  x
+        self.assertEqual(self.next_pieces(self.a, 8),
+                         [(1, 0), (1, 1), (0, 0), (0, 1),
+                          (2, 0), (2, 1), (3, 0), (3, 1)])
+
+    def test_reorder_interval(self):
+        """
+        Test that requests aren't reordered more often than the reorder interval.
+        """
+        self.requester._reorder_interval = 60
+        self.assertEqual(self.next_pieces(self.c, 1), [(2, 0)])
+        # Piece 0 becomes the most available, but the order is kept for now.
+        self.add_pieces(self.b, (0,))
+        self.add_pieces(self.c, (0,))
+        self.assertEqual(self.next_pieces(self.a, 1), [(0, 0)])
+
+        # Once the interval has passed, the started pieces come first,
+        # followed by the now rarest piece.
+        self.requester._ordered_at -= 60
+        self.assertEqual(self.next_pieces(self.a, 4), [(0, 1), (2, 1), (3, 0), (3, 1)])
+
+    def test_fill_only_room_left(self):
+        """
+        Test that no more requests are made than there's room for in the
+        peer's send queue.
+        """
+        msg_queue = deque([None] * 3)
+        self.assertTrue(self.requester.fill_peer_request_queue(self.a, msg_queue, 5))
+        self.assertEqual(len(msg_queue), 5)
+        with self.subTest(msg="Only queued requests are outstanding"):
+            self.assertEqual(len(self.requester.peer_outstanding_requests(self.a)), 2)
+        with self.subTest(msg="Full queue"):
+            self.assertFalse(self.requester.fill_peer_request_queue(self.a, msg_queue, 5))